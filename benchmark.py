@@ -0,0 +1,321 @@
+"""Benchmarks for the heatmap render pipeline on synthetic videos and click streams.
+
+    python3 benchmark.py --output results.json
+    python3 benchmark.py --resolution 1920x1080 --duration 60 --fps 30 --no-audio
+    python3 benchmark.py --output new.json --compare old.json
+
+Every run generates its inputs in a temp directory: a test-pattern video (ffmpeg, or
+OpenCV without audio when ffmpeg is missing), turbo-rate click streams and a study
+folder with several participants. It times the stages of heatmap.py on them, checks
+that the fast paths still match their references, and writes the results with the
+git commit they were measured at as JSON, so runs can be compared across commits.
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+import cv2
+import numpy as np
+
+import heatmap
+
+def parse_resolution(value):
+    w, h = value.lower().split('x')
+    return int(w), int(h)
+
+def make_video(path, size, duration, fps, audio=True):
+    """Write a moving test-pattern video, with a sine tone as audio if asked and ffmpeg is available"""
+    w, h = size
+    if shutil.which('ffmpeg'):
+        cmd = ['ffmpeg', '-loglevel', 'error', '-f', 'lavfi', '-i', f'testsrc2=size={w}x{h}:rate={fps}:duration={duration}']
+        if audio:
+            cmd += ['-f', 'lavfi', '-i', f'sine=frequency=440:duration={duration}', '-c:a', 'aac']
+        cmd += ['-c:v', 'libx264', '-preset', 'veryfast', '-pix_fmt', 'yuv420p', '-y', path]
+        subprocess.run(cmd, check=True)
+        return path
+    
+    out = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (w, h))
+    gradient = np.tile(np.linspace(0, 255, w, dtype=np.float32), (h, 1))
+    for i in range(int(duration * fps)):
+        shift = int(i * w / (duration * fps))
+        channel = np.roll(gradient, shift, axis=1).astype(np.uint8)
+        out.write(cv2.merge([channel, channel[::-1], np.full_like(channel, (i * 5) % 256)]))
+    out.release()
+    return path
+
+def make_clicks(duration, rate, seed=0):
+    """Clicks at rate per second along a random-walk gaze path, like a turbo-clicking controller"""
+    rng = np.random.default_rng(seed)
+    count = int(duration * rate)
+    timestamps = np.sort(rng.uniform(0, duration, count))
+    steps = rng.normal(0, 0.02, (count, 2))
+    path = np.clip(0.5 + np.cumsum(steps, axis=0), 0.0, 0.999)
+    return [{"x": float(x), "y": float(y), "timestamp": float(t)} for (x, y), t in zip(path, timestamps)]
+
+def make_study_folder(folder, video_path, participants, duration, rate):
+    """A --folder style directory: the video plus one tracking JSON per participant"""
+    os.makedirs(folder, exist_ok=True)
+    shutil.copy(video_path, folder)
+    for i in range(participants):
+        add_participant(folder, i, duration, rate)
+    return folder
+
+def add_participant(folder, index, duration, rate):
+    data = {
+        "user_name": f"participant_{index}",
+        "precision_score": 90.0,
+        "tracking_type": "heatmap",
+        "timestamp": "20250101_000000",
+        "click_data": make_clicks(duration, rate, seed=index)
+    }
+    with open(os.path.join(folder, f"participant_{index}.json"), 'w') as f:
+        json.dump(data, f)
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    """Peak resident set size in MB; ru_maxrss is in bytes on macOS and KB elsewhere"""
+    peak = resource.getrusage(who).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def video_frame_count(path):
+    cap = cv2.VideoCapture(path)
+    count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    cap.release()
+    return count
+
+def compare_videos(path_a, path_b, max_frames=None):
+    """Frame counts of both videos and the max / mean absolute pixel difference over their common frames"""
+    cap_a, cap_b = cv2.VideoCapture(path_a), cv2.VideoCapture(path_b)
+    max_diff, total_diff, compared = 0, 0.0, 0
+    while max_frames is None or compared < max_frames:
+        ret_a, frame_a = cap_a.read()
+        ret_b, frame_b = cap_b.read()
+        if not ret_a or not ret_b:
+            break
+        diff = cv2.absdiff(frame_a, frame_b)
+        max_diff = max(max_diff, int(diff.max()))
+        total_diff += float(diff.mean())
+        compared += 1
+    cap_a.release()
+    cap_b.release()
+    return {
+        "frames_a": video_frame_count(path_a),
+        "frames_b": video_frame_count(path_b),
+        "compared_frames": compared,
+        "max_abs_diff": max_diff,
+        "mean_abs_diff": total_diff / compared if compared else None
+    }
+
+def bench_overlays(click_data, size):
+    """Dense GaussianBlur reference against the splat renderer for the final aggregate frame"""
+    w, h = size
+    xs, ys, brightness = heatmap.build_final_click_points(click_data, w, h)
+    grid = np.zeros((h, w), dtype=np.float32)
+    grid[ys, xs] = brightness
+    
+    reference, reference_seconds = timed(heatmap.create_heatmap_overlay, grid, w, h)
+    splat, splat_seconds = timed(heatmap.create_splat_heatmap_overlay, xs, ys, brightness, w, h)
+    
+    background = np.zeros((h, w, 3), dtype=np.uint8)
+    expected = cv2.addWeighted(background, 1.0, reference, 0.8, 0)
+    actual = heatmap.apply_splat_heatmap(background, splat)
+    return {
+        "create_heatmap_overlay": {"seconds": reference_seconds},
+        "create_splat_heatmap_overlay": {"seconds": splat_seconds, "points": int(len(xs))}
+    }, {"overlay_max_abs_diff": int(cv2.absdiff(expected, actual).max())}
+
+def bench_compositing(frame_events, size, frame_count, max_frames=300):
+    """In-place per-frame compositing against the allocating reference, timed after a warm-up pass that grows the scratch buffers"""
+    w, h = size
+    frames = range(min(frame_count, max_frames))
+    background = np.random.default_rng(0).integers(0, 256, (h, w, 3), dtype=np.uint8)
+    buffer = np.empty_like(background)
+    
+    def reference(frame_idx):
+        heatmap_overlay = heatmap.create_splat_heatmap_overlay(*heatmap.frame_brightness_points(frame_events, frame_idx), w, h)
+        darkened = cv2.addWeighted(background, 0.5, np.zeros_like(background), 0.5, 0)
+        return darkened if heatmap_overlay is None else heatmap.apply_splat_heatmap(darkened, heatmap_overlay)
+    
+    def in_place(frame_idx):
+        np.copyto(buffer, background)
+        return heatmap.render_heatmap_frame(buffer, frame_events, frame_idx, w, h)
+    
+    stages, mismatches = {}, 0
+    for name, render in (("composite_reference", reference), ("composite_in_place", in_place)):
+        for frame_idx in frames:
+            render(frame_idx)
+        start = time.perf_counter()
+        for frame_idx in frames:
+            render(frame_idx)
+        seconds = time.perf_counter() - start
+        
+        # Traced separately, since tracing slows the small allocations down more than the large ones
+        tracemalloc.start()
+        for frame_idx in frames:
+            render(frame_idx)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        stages[name] = {"seconds": seconds, "ms_per_frame": seconds / max(len(frames), 1) * 1000,
+                        "peak_alloc_mb": peak / (1024 * 1024)}
+    
+    for frame_idx in frames[::10]:
+        mismatches += not np.array_equal(reference(frame_idx), in_place(frame_idx))
+    return stages, {"composite_in_place_mismatched_frames": mismatches}
+
+def run_benchmarks(args, workdir):
+    size = parse_resolution(args.resolution)
+    stages, checks = {}, {}
+    
+    heatmap.OUTPUT_DIR = os.path.join(workdir, "output")
+    heatmap.AGGREGATE_DIR = os.path.join(heatmap.OUTPUT_DIR, ".aggregates")
+    heatmap.result_cache = heatmap.ResultCache(cache_dir=os.path.join(heatmap.OUTPUT_DIR, ".cache"))
+    heatmap.frame_cache = heatmap.FrameCache(cache_dir=os.path.join(heatmap.OUTPUT_DIR, ".frames"))
+    
+    video_path, seconds = timed(make_video, os.path.join(workdir, "synthetic.mp4"), size, args.duration, args.fps,
+                                audio=not args.no_audio)
+    frame_count = video_frame_count(video_path)
+    stages["make_video"] = {"seconds": seconds, "frames": frame_count}
+    
+    click_data = make_clicks(args.duration, args.click_rate)
+    tracking_data = {"user_name": "benchmark", "tracking_type": "heatmap", "timestamp": "serial", "click_data": click_data}
+    
+    (_, scale_x, scale_y), seconds = timed(heatmap.reduce_video_quality, video_path)
+    stages["reduce_video_quality"] = {"seconds": seconds}
+    render_size = (round(size[0] * scale_x), round(size[1] * scale_y))
+    
+    frame_events, seconds = timed(heatmap.build_click_events, click_data, *render_size, args.fps, frame_count)
+    stages["build_click_events"] = {"seconds": seconds, "clicks": len(click_data)}
+    
+    compositing_stages, compositing_checks = bench_compositing(frame_events, render_size, frame_count)
+    stages.update(compositing_stages)
+    checks.update(compositing_checks)
+    
+    overlay_stages, overlay_checks = bench_overlays(click_data, render_size)
+    stages.update(overlay_stages)
+    checks.update(overlay_checks)
+    
+    render_stats = heatmap.RenderStats()
+    serial_path, seconds = timed(heatmap.generate_heatmap, video_path, tracking_data, stats=render_stats)
+    stages["generate_heatmap"] = {"seconds": seconds, "fps": frame_count / seconds, "ok": bool(serial_path),
+                                  **render_stats.to_dict()}
+    
+    if args.processes > 1 and serial_path:
+        segmented_path, seconds = timed(heatmap.generate_heatmap, video_path, {**tracking_data, "timestamp": "segmented"},
+                                        processes=args.processes)
+        stages["generate_heatmap_segmented"] = {"seconds": seconds, "fps": frame_count / seconds,
+                                                "processes": args.processes, "ok": bool(segmented_path)}
+        if segmented_path:
+            checks["segmented_vs_serial"] = compare_videos(serial_path, segmented_path)
+    
+    if serial_path:
+        # The first render fills the frame cache, the second only composites over the cached frames
+        heatmap.FRAME_CACHE_ENABLED = True
+        try:
+            for name in ("frame_cache_fill", "frame_cache_hit"):
+                cached_path, seconds = timed(heatmap.generate_heatmap, video_path, {**tracking_data, "timestamp": name})
+                stages[f"generate_heatmap_{name}"] = {"seconds": seconds, "fps": frame_count / seconds,
+                                                      "ok": bool(cached_path)}
+            if cached_path:
+                checks["frame_cache_vs_serial"] = compare_videos(serial_path, cached_path)
+        finally:
+            heatmap.FRAME_CACHE_ENABLED = False
+    
+    _, seconds = timed(heatmap.generate_static_heatmap, video_path, tracking_data)
+    stages["generate_static_heatmap"] = {"seconds": seconds}
+    
+    folder = make_study_folder(os.path.join(workdir, "study"), video_path, args.participants, args.duration, args.click_rate)
+    output_folder = os.path.join(workdir, "averaged")
+    result, seconds = timed(heatmap.process_folder, folder, output_folder)
+    stages["process_folder"] = {"seconds": seconds, "participants": args.participants, "ok": bool(result)}
+    
+    _, seconds = timed(heatmap.process_folder, folder, output_folder)
+    stages["process_folder_cached"] = {"seconds": seconds}
+    
+    add_participant(folder, args.participants, args.duration, args.click_rate)
+    _, seconds = timed(heatmap.process_folder, folder, output_folder)
+    stages["process_folder_one_added"] = {"seconds": seconds, "participants": args.participants + 1}
+    
+    return {
+        "commit": git_commit(),
+        "timestamp": datetime.now().isoformat(timespec='seconds'),
+        "platform": {"system": platform.platform(), "python": platform.python_version(), "cpus": os.cpu_count(),
+                     "ffmpeg": bool(shutil.which('ffmpeg'))},
+        "params": {"resolution": args.resolution, "duration": args.duration, "fps": args.fps, "audio": not args.no_audio,
+                   "click_rate": args.click_rate, "participants": args.participants, "processes": args.processes},
+        "stages": stages,
+        "checks": checks,
+        "peak_rss_mb": peak_rss_mb(),
+        "children_peak_rss_mb": peak_rss_mb(resource.RUSAGE_CHILDREN)
+    }
+
+def git_commit():
+    try:
+        result = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+        return result.stdout.strip() or None
+    except OSError:
+        return None
+
+def print_results(results, baseline=None):
+    print(f"\nCommit {results['commit']}, {results['params']}")
+    for name, stage in results["stages"].items():
+        line = f"  {name:32s} {stage['seconds']:9.3f}s"
+        if "fps" in stage:
+            line += f"  {stage['fps']:8.1f} frames/s"
+        if baseline and name in baseline["stages"] and baseline["stages"][name]["seconds"]:
+            line += f"  x{stage['seconds'] / baseline['stages'][name]['seconds']:.2f} vs {baseline['commit']}"
+        print(line)
+    print(f"  peak RSS {results['peak_rss_mb']:.0f} MB (children {results['children_peak_rss_mb']:.0f} MB)")
+    for name, check in results["checks"].items():
+        print(f"  check {name}: {check}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the heatmap render pipeline on synthetic inputs')
+    parser.add_argument('--resolution', type=str, default='1280x720', help='Synthetic video size, WxH (default: 1280x720)')
+    parser.add_argument('--duration', type=float, default=20, help='Synthetic video length in seconds (default: 20)')
+    parser.add_argument('--fps', type=int, default=30, help='Synthetic video frame rate (default: 30)')
+    parser.add_argument('--no-audio', action='store_true', help='Generate the video without an audio track')
+    parser.add_argument('--click-rate', type=float, default=15, help='Clicks per second per participant (default: 15)')
+    parser.add_argument('--participants', type=int, default=5, help='Participants in the averaged study folder (default: 5)')
+    parser.add_argument('--processes', type=int, default=4, help='Segments for the parallel render, 1 to skip (default: 4)')
+    parser.add_argument('--output', '-o', type=str, help='Write the results as JSON to this path')
+    parser.add_argument('--compare', type=str, help='Earlier results JSON to show timing ratios against')
+    parser.add_argument('--keep', action='store_true', help='Keep the generated inputs and outputs')
+    
+    args = parser.parse_args()
+    
+    workdir = tempfile.mkdtemp(prefix="heatmap_benchmark_")
+    try:
+        results = run_benchmarks(args, workdir)
+    finally:
+        if args.keep:
+            print(f"Benchmark files kept in {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+    
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+    
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -14,23 +14,197 @@ import threading
 import socket
 from zeroconf import ServiceInfo, Zeroconf
 import uuid
+import hashlib
 import shutil
 import sys
 import argparse
 import glob
+import functools
+import queue
+import contextlib
+import csv
+import fcntl
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 # Configuration
 OUTPUT_DIR = os.path.expanduser("~/Desktop/Heatmap")
+VIDEO_EXTENSIONS = ['*.mp4', '*.avi', '*.mov', '*.mkv', '*.flv', '*.wmv']
+
+# Render parameters: heatmap blur sigma at the base resolution, click fade window, and the largest render size
+HEATMAP_SIGMA = 40
+HEATMAP_BASE_RESOLUTION = 1920
+FADE_SECONDS = 0.3
+MAX_RENDER_SIZE = (1280, 720)
+
+# Render pipeline: overlay worker threads and bounded queue depths between the decode, overlay and encode stages
+RENDER_WORKERS = os.cpu_count() or 4
+DECODE_QUEUE_DEPTH = 16
+ENCODE_QUEUE_DEPTH = 32
+
+# Segmented rendering: worker processes for time segments of one video, and the shortest segment worth splitting off
+RENDER_PROCESSES = 1
+MIN_SEGMENT_SECONDS = 10
+
+# Job queue: renders that run at once, and how long finished jobs stay available for status and result lookups
+JOB_WORKERS = 2
+JOB_RETENTION_SECONDS = 3600
+
+# Result cache: rendered heatmaps keyed by their inputs, evicted least-recently-used beyond the size limit
+CACHE_DIR = os.path.join(OUTPUT_DIR, ".cache")
+CACHE_MAX_BYTES = 2 * 1024 ** 3
+
+# Frame cache: darkened, downscaled background frames keyed by video hash and render size, off unless enabled,
+# and how long a partly written entry may go untouched before it counts as abandoned
+FRAME_CACHE_ENABLED = False
+FRAME_CACHE_DIR = os.path.join(OUTPUT_DIR, ".frames")
+FRAME_CACHE_MAX_BYTES = 16 * 1024 ** 3
+FRAME_CACHE_TEMP_SECONDS = 3600
+
+# Averaged heatmaps: persisted per-video click aggregates, updated per participant file
+AGGREGATE_DIR = os.path.join(OUTPUT_DIR, ".aggregates")
+
+# Progressive output: HLS segment length in seconds, and the playlist name inside a job's segment directory
+HLS_SEGMENT_SECONDS = 4
+HLS_PLAYLIST = "index.m3u8"
+
+# Spatial capture: screen recording frame rate and size, and for live recordings the capture segment length and
+# how far past a segment's fade windows the gaze stream must reach before the segment is rendered
+CAPTURE_FPS = 20
+CAPTURE_SIZE = (1280, 720)
+LIVE_SEGMENT_SECONDS = 10
+LIVE_RENDER_MARGIN_SECONDS = 1.0
+
+# Abandoned recordings: the longest a capture runs, and how long a recording nobody stopped is kept after that
+RECORDING_MAX_SECONDS = 2 * 3600
+RECORDING_RETENTION_SECONDS = 600
+
+# AOI statistics: the longest one gaze sample counts toward dwell time, and the cells per side of the AOI grid index
+AOI_MAX_SAMPLE_SECONDS = 0.5
+AOI_GRID_SIZE = 32
+
+# Resumable uploads: where partial uploads are written, the request body read size, and how long an idle upload is kept
+UPLOAD_DIR = os.path.join(OUTPUT_DIR, ".uploads")
+UPLOAD_READ_SIZE = 1 << 20
+UPLOAD_RETENTION_SECONDS = 24 * 3600
+
+# Metrics: upper bounds in seconds of the stage-duration histogram buckets
+STAGE_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900)
 
 # Global state
 app = Flask(__name__)
 CORS(app)
 
+class Metrics:
+    """Process-wide counters and per-stage duration histograms, served by /metrics"""
+    
+    def __init__(self, buckets=STAGE_BUCKETS):
+        self.buckets = buckets
+        self.counters = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+    
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+    
+    def observe(self, stage, seconds):
+        with self.lock:
+            histogram = self.histograms.setdefault(stage, {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0})
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram["buckets"][i] += 1
+            histogram["sum"] += seconds
+            histogram["count"] += 1
+    
+    def snapshot(self):
+        with self.lock:
+            counters = [{"name": name, "labels": dict(labels), "value": value}
+                        for (name, labels), value in sorted(self.counters.items())]
+            histograms = {stage: {"buckets": dict(zip(map(str, self.buckets), h["buckets"])), "sum": h["sum"],
+                                  "count": h["count"]}
+                          for stage, h in sorted(self.histograms.items())}
+        return {"counters": counters, "stage_seconds": histograms}
+    
+    def prometheus(self, gauges=()):
+        """Prometheus text exposition of the counters, the histograms and extra (name, value) gauges"""
+        def label_text(labels):
+            return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}" if labels else ""
+        
+        lines = []
+        with self.lock:
+            for name in sorted({name for name, _ in self.counters}):
+                lines.append(f"# TYPE {name} counter")
+                for (counter, labels), value in sorted(self.counters.items()):
+                    if counter == name:
+                        lines.append(f"{name}{label_text(labels)} {value}")
+            
+            lines.append("# TYPE heatmap_stage_seconds histogram")
+            for stage, histogram in sorted(self.histograms.items()):
+                for bound, count in zip(self.buckets, histogram["buckets"]):
+                    lines.append(f'heatmap_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {count}')
+                lines.append(f'heatmap_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {histogram["count"]}')
+                lines.append(f'heatmap_stage_seconds_sum{{stage="{stage}"}} {histogram["sum"]:.6f}')
+                lines.append(f'heatmap_stage_seconds_count{{stage="{stage}"}} {histogram["count"]}')
+        
+        for name, value in gauges:
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+def record_fallback(name, error=None, stats=None):
+    """Count a slow or degraded fallback instead of hiding it, and note it on the render's stats"""
+    print(f"Fallback in {name}: {error}" if error else f"Fallback in {name}")
+    metrics.inc("heatmap_fallbacks_total", stage=name)
+    if stats:
+        stats.fallbacks.append({"stage": name, "error": str(error) if error else None})
+
+class RenderStats:
+    """Stage durations, counts and fallbacks of one render, folded into metrics when it finishes.
+    
+    Stages of the render pipeline overlap, so decode, overlay and encode are busy time
+    summed over their threads rather than wall time.
+    """
+    
+    def __init__(self):
+        self.stages = {}
+        self.counts = {}
+        self.fallbacks = []
+        self.lock = threading.Lock()
+    
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+    
+    def add_time(self, name, seconds):
+        with self.lock:
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+    
+    def count(self, name, value=1):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + value
+    
+    def finish(self, status):
+        metrics.inc("heatmap_renders_total", status=status)
+        for name, seconds in self.stages.items():
+            metrics.observe(name, seconds)
+        for name, value in self.counts.items():
+            metrics.inc(f"heatmap_{name}_total", value)
+    
+    def to_dict(self):
+        with self.lock:
+            return {"stage_seconds": {name: round(seconds, 4) for name, seconds in self.stages.items()},
+                    "counts": dict(self.counts), "fallbacks": list(self.fallbacks)}
+
 def find_video_file(folder_path):
     """Find the first video file in the folder"""
-    video_extensions = ['*.mp4', '*.avi', '*.mov', '*.mkv', '*.flv', '*.wmv']
-    
-    for ext in video_extensions:
+    for ext in VIDEO_EXTENSIONS:
         video_files = glob.glob(os.path.join(folder_path, ext))
         if video_files:
             print(f"Found video file: {video_files[0]}")
@@ -39,7 +213,22 @@ def find_video_file(folder_path):
     print(f"No video files found in {folder_path}")
     return None
 
-def reduce_video_quality(input_path, max_width=1280, max_height=720, crf=28):
+def has_audio_stream(video_path, stats=None):
+    """Check with ffprobe whether the video has an audio stream"""
+    probe_cmd = ['ffprobe', '-v', 'quiet', '-select_streams', 'a', '-show_entries', 'stream=codec_type', '-of', 'csv=p=0', video_path]
+    try:
+        result = subprocess.run(probe_cmd, capture_output=True, text=True)
+        return 'audio' in result.stdout
+    except Exception as e:
+        record_fallback('audio_probe', e, stats)
+        return False
+
+def reduce_video_quality(input_path, max_width=MAX_RENDER_SIZE[0], max_height=MAX_RENDER_SIZE[1], stats=None):
+    """Pick the render resolution for input_path, capped at max_width x max_height.
+    
+    Nothing is transcoded: frames are downscaled while decoding (see FFmpegPipeReader),
+    so the input path is returned unchanged along with the x/y scale factors.
+    """
     try:
         cap = cv2.VideoCapture(input_path)
         w, h = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
@@ -51,42 +240,409 @@ def reduce_video_quality(input_path, max_width=1280, max_height=720, crf=28):
         if scale >= 0.95: 
             return input_path, 1.0, 1.0
         
-        reduced_path = input_path.replace('.mp4', '_reduced.mp4')
-        
-        # Check if input has audio and preserve it
-        probe_cmd = ['ffprobe', '-v', 'quiet', '-select_streams', 'a', '-show_entries', 'stream=codec_type', '-of', 'csv=p=0', input_path]
-        has_audio = False
-        try:
-            result = subprocess.run(probe_cmd, capture_output=True, text=True)
-            has_audio = 'audio' in result.stdout
-        except:
-            pass
-        
-        if has_audio:
-            cmd = ['ffmpeg', '-i', input_path, '-vf', f'scale={new_w}:{new_h}',
-                   '-c:v', 'libx264', '-c:a', 'aac', '-preset', 'ultrafast', '-crf', str(crf), '-y', reduced_path]
-        else:
-            cmd = ['ffmpeg', '-i', input_path, '-vf', f'scale={new_w}:{new_h}',
-                   '-c:v', 'libx264', '-preset', 'ultrafast', '-crf', str(crf), '-an', '-y', reduced_path]
-        
-        if subprocess.run(cmd, capture_output=True).returncode == 0:
-            return reduced_path, new_w / w, new_h / h
-        return input_path, 1.0, 1.0
-    except:
+        return input_path, new_w / w, new_h / h
+    except Exception as e:
+        # Rendering at full input resolution is correct but can be much slower
+        record_fallback('downscale', e, stats)
         return input_path, 1.0, 1.0
 
-def create_heatmap_overlay(brightness_grid, video_width, video_height, base_sigma=40, base_resolution=1920):
+class FFmpegPipeReader:
+    """cv2.VideoCapture-style reader that decodes through ffmpeg, scaling frames to frame_size.
+    
+    Frames arrive as raw BGR over a pipe, so downscaled inputs need no intermediate file.
+    ffmpeg's errors go to a temp file rather than a pipe nobody drains, and release()
+    raises them if ffmpeg failed instead of being stopped early.
+    """
+    
+    def __init__(self, input_path, frame_size, scale=True, start_time=None, max_frames=None):
+        w, h = frame_size
+        self.frame_shape = (h, w, 3)
+        cmd = ['ffmpeg', '-loglevel', 'error']
+        if start_time:
+            cmd += ['-ss', f'{start_time:.6f}']
+        # -vsync rather than -fps_mode, which ffmpeg before 5.1 rejects
+        cmd += ['-i', input_path, '-an', '-sn', '-vsync', 'passthrough']
+        if max_frames is not None:
+            cmd += ['-frames:v', str(max_frames)]
+        if scale:
+            cmd += ['-vf', f'scale={w}:{h}']
+        cmd += ['-f', 'rawvideo', '-pix_fmt', 'bgr24', '-']
+        
+        self.stderr = tempfile.TemporaryFile()
+        self.process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=self.stderr)
+        self.frames_read = 0
+    
+    def isOpened(self):
+        return self.process.stdout is not None and not self.process.stdout.closed
+    
+    def read(self, image=None):
+        """Read the next frame into image if it has the frame's shape, else into a new array"""
+        frame = image if image is not None and image.shape == self.frame_shape else np.empty(self.frame_shape, dtype=np.uint8)
+        if self.process.stdout.readinto(memoryview(frame).cast('B')) != frame.nbytes:
+            return False, None
+        self.frames_read += 1
+        return True, frame
+    
+    def release(self):
+        if self.process.stdout.closed:
+            return
+        stopped = self.process.poll() is None
+        if stopped:
+            self.process.terminate()
+        self.process.stdout.close()
+        returncode = self.process.wait()
+        self.stderr.seek(0)
+        stderr = self.stderr.read().decode(errors='replace').strip()
+        self.stderr.close()
+        if returncode != 0 and not stopped:
+            raise RuntimeError(f"ffmpeg decode failed after {self.frames_read} frames: {stderr or f'exit code {returncode}'}")
+
+def get_heatmap_sigma(video_width, base_sigma=HEATMAP_SIGMA, base_resolution=HEATMAP_BASE_RESOLUTION):
+    resolution_scale = video_width / base_resolution
+    return max(base_sigma * resolution_scale, 5.0)
+
+def create_heatmap_overlay(brightness_grid, video_width, video_height, base_sigma=HEATMAP_SIGMA, base_resolution=HEATMAP_BASE_RESOLUTION):
+    """Full-frame reference renderer: blur the dense brightness grid and colour-map it"""
     if np.sum(brightness_grid) == 0: 
         return None
     
-    resolution_scale = video_width / base_resolution
-    scaled_sigma = max(base_sigma * resolution_scale, 5.0)
+    scaled_sigma = get_heatmap_sigma(video_width, base_sigma, base_resolution)
     
     blurred = cv2.GaussianBlur(brightness_grid.astype(np.float32), (0, 0), scaled_sigma)
     if np.max(blurred) > 0:
         blurred = (blurred / np.max(blurred) * 255).astype(np.uint8)
     return cv2.applyColorMap(blurred, cv2.COLORMAP_INFERNO)
 
+@functools.lru_cache(maxsize=8)
+def get_splat_kernel(sigma):
+    """1D Gaussian kernel matching the one cv2.GaussianBlur derives for a float32 image"""
+    ksize = int(round(sigma * 8 + 1)) | 1
+    kernel = cv2.getGaussianKernel(ksize, sigma, cv2.CV_32F).ravel()
+    kernel.setflags(write=False)
+    return kernel
+
+@functools.lru_cache(maxsize=4096)
+def get_splat_profile(center, size, sigma):
+    """Blur response along an axis of length size to a unit impulse at center.
+    
+    Near the borders the kernel is summed over the impulse's mirror images, which is
+    what BORDER_REFLECT_101 in cv2.GaussianBlur amounts to. Returns (start, profile).
+    """
+    kernel = get_splat_kernel(sigma)
+    radius = len(kernel) // 2
+    if radius < center < size - 1 - radius:
+        return center - radius, kernel
+    
+    start, end = max(center - radius, 0), min(center + radius, size - 1)
+    positions = np.arange(start, end + 1)
+    profile = np.zeros(len(positions), dtype=np.float32)
+    
+    period = 2 * (size - 1)
+    mirror_images = {center}
+    if period > 0:
+        for t in range(-(radius // period) - 1, radius // period + 2):
+            mirror_images.update((center + t * period, -center + t * period))
+    
+    for image in mirror_images:
+        offsets = positions - image + radius
+        valid = (offsets >= 0) & (offsets < len(kernel))
+        profile[valid] += kernel[offsets[valid]]
+    
+    profile.setflags(write=False)
+    return start, profile
+
+def collect_splats(xs, ys, brightness, video_width, video_height, sigma):
+    """(x0, y0, profile_x, profile_y, brightness) per lit point, and the (x0, y0, x1, y1) box they cover"""
+    splats = []
+    for x, y, b in zip(xs, ys, brightness):
+        if b > 0:
+            x0, profile_x = get_splat_profile(int(x), video_width, sigma)
+            y0, profile_y = get_splat_profile(int(y), video_height, sigma)
+            splats.append((x0, y0, profile_x, profile_y, np.float32(b)))
+    
+    if not splats:
+        return splats, None
+    return splats, (min(s[0] for s in splats), min(s[1] for s in splats),
+                    max(s[0] + len(s[2]) for s in splats), max(s[1] + len(s[3]) for s in splats))
+
+def create_splat_density(xs, ys, brightness, video_width, video_height, base_sigma=HEATMAP_SIGMA, base_resolution=HEATMAP_BASE_RESOLUTION):
+    """Blurred float32 density of sparse (x, y, brightness) points, adding a cached kernel per point.
+    
+    Returns (density, x0, y0) for the bounding box of the splats, or None when no point
+    is lit; the density is zero everywhere outside the box. Cost grows with the number
+    of points, not with the frame size.
+    """
+    scaled_sigma = get_heatmap_sigma(video_width, base_sigma, base_resolution)
+    splats, box = collect_splats(xs, ys, brightness, video_width, video_height, scaled_sigma)
+    if not splats:
+        return None
+    
+    roi_x0, roi_y0, roi_x1, roi_y1 = box
+    blurred = np.zeros((roi_y1 - roi_y0, roi_x1 - roi_x0), dtype=np.float32)
+    for x0, y0, profile_x, profile_y, b in splats:
+        x0, y0 = x0 - roi_x0, y0 - roi_y0
+        blurred[y0:y0 + len(profile_y), x0:x0 + len(profile_x)] += np.outer(profile_y * b, profile_x)
+    return blurred, roi_x0, roi_y0
+
+def create_splat_heatmap_overlay(xs, ys, brightness, video_width, video_height, base_sigma=HEATMAP_SIGMA, base_resolution=HEATMAP_BASE_RESOLUTION):
+    """Render the heatmap for sparse (x, y, brightness) points from their create_splat_density.
+    
+    Produces the create_heatmap_overlay result restricted to the bounding box of the
+    splats, returned as (heatmap, x0, y0), or None when no point is lit. Everything
+    outside the box is colour-map level 0 in the full-frame renderer. Within the box,
+    colour-map indices match the full-frame renderer to within 1 level: the blur
+    arithmetic is the same but float32 rounding order differs before truncation.
+    """
+    density = create_splat_density(xs, ys, brightness, video_width, video_height, base_sigma, base_resolution)
+    if density is None:
+        return None
+    return colorize_splat_density(density)
+
+def colorize_splat_density(density):
+    """Scale a (density, x0, y0) splat density to its maximum and colour-map it to (heatmap, x0, y0)"""
+    blurred, roi_x0, roi_y0 = density
+    max_value = np.max(blurred)
+    if max_value > 0:
+        blurred = (blurred / max_value * 255).astype(np.uint8)
+    else:
+        blurred = blurred.astype(np.uint8)
+    return cv2.applyColorMap(blurred, cv2.COLORMAP_INFERNO), roi_x0, roi_y0
+
+@functools.lru_cache(maxsize=1)
+def get_heatmap_background_offset():
+    """Per-channel value the 0.8 overlay blend adds where the heatmap is colour-map level 0"""
+    level_zero = cv2.applyColorMap(np.zeros((1, 1), dtype=np.uint8), cv2.COLORMAP_INFERNO)
+    offset = cv2.addWeighted(np.zeros_like(level_zero), 1.0, level_zero, 0.8, 0)
+    return tuple(float(c) for c in offset[0, 0]) + (0.0,)
+
+@functools.lru_cache(maxsize=1)
+def get_heatmap_blend_lut():
+    """(256, 1, 3) cv2.LUT table of what the 0.8 overlay blend adds to a darkened pixel per colour-map level.
+    
+    Darkened pixels are whole numbers, so cv2.addWeighted(darkened, 1.0, heatmap, 0.8, 0)
+    equals cv2.add(darkened, lut[level]) exactly.
+    """
+    colors = cv2.applyColorMap(np.arange(256, dtype=np.uint8).reshape(256, 1), cv2.COLORMAP_INFERNO)
+    lut = cv2.addWeighted(np.zeros_like(colors), 1.0, colors, 0.8, 0)
+    lut.setflags(write=False)
+    return lut
+
+def darken_frame(frame, dst=None):
+    """The half-brightness background every heatmap is blended onto; with dst=frame, darkens in place"""
+    return cv2.addWeighted(frame, 0.5, frame, 0.0, 0, dst=dst)
+
+def apply_splat_heatmap(darkened, overlay):
+    """Blend a (heatmap, x0, y0) splat overlay onto a darkened frame like cv2.addWeighted(..., 0.8)"""
+    heatmap, x0, y0 = overlay
+    hh, hw = heatmap.shape[:2]
+    result = cv2.add(darkened, get_heatmap_background_offset())
+    result[y0:y0 + hh, x0:x0 + hw] = cv2.addWeighted(darkened[y0:y0 + hh, x0:x0 + hw], 1.0, heatmap, 0.8, 0)
+    return result
+
+class FrameCompositor:
+    """Darkens frames and blends their splat heatmaps in place, for the per-frame render path.
+    
+    The result equals apply_splat_heatmap(darken_frame(frame), create_splat_heatmap_overlay(...)),
+    but every step writes into the frame or into grow-only scratch buffers kept per
+    thread, and the blend colours are looked up in get_heatmap_blend_lut instead of
+    colour-mapped and weighted. Once the buffers have grown, compositing a frame
+    allocates nothing frame-sized.
+    """
+    
+    def __init__(self, w, h, base_sigma=HEATMAP_SIGMA, base_resolution=HEATMAP_BASE_RESOLUTION):
+        self.w, self.h = w, h
+        self.sigma = get_heatmap_sigma(w, base_sigma, base_resolution)
+        self.local = threading.local()
+    
+    def scratch(self, name, shape, dtype):
+        """This thread's buffer called name, grown to at least shape, as a view of exactly shape"""
+        buffer = getattr(self.local, name, None)
+        if buffer is None or any(have < need for have, need in zip(buffer.shape, shape)):
+            grown = shape if buffer is None else tuple(max(have, need) for have, need in zip(buffer.shape, shape))
+            buffer = np.empty(grown, dtype=dtype)
+            setattr(self.local, name, buffer)
+        return buffer[tuple(slice(0, n) for n in shape)]
+    
+    def blend(self, frame, xs, ys, brightness, darkened=False):
+        """Darken frame, unless already darkened, and add the heatmap of the (xs, ys, brightness) points to it"""
+        if not darkened:
+            darken_frame(frame, frame)
+        
+        # No active gaze: the darkened frame is the whole result
+        splats, box = collect_splats(xs, ys, brightness, self.w, self.h, self.sigma)
+        if not splats:
+            return frame
+        
+        roi_x0, roi_y0, roi_x1, roi_y1 = box
+        density = self.scratch('density', (roi_y1 - roi_y0, roi_x1 - roi_x0), np.float32)
+        density.fill(0)
+        for x0, y0, profile_x, profile_y, b in splats:
+            x0, y0 = x0 - roi_x0, y0 - roi_y0
+            splat = self.scratch('splat', (len(profile_y), len(profile_x)), np.float32)
+            np.multiply.outer(profile_y * b, profile_x, out=splat)
+            density[y0:y0 + len(profile_y), x0:x0 + len(profile_x)] += splat
+        
+        # Same arithmetic as colorize_splat_density, without its temporaries
+        max_value = np.max(density)
+        if max_value > 0:
+            np.divide(density, max_value, out=density)
+            np.multiply(density, 255, out=density)
+        levels = self.scratch('levels', density.shape, np.uint8)
+        np.copyto(levels, density, casting='unsafe')
+        colors = self.scratch('colors', density.shape + (3,), np.uint8)
+        cv2.cvtColor(levels, cv2.COLOR_GRAY2BGR, dst=colors)
+        cv2.LUT(colors, get_heatmap_blend_lut(), dst=colors)
+        
+        roi = frame[roi_y0:roi_y1, roi_x0:roi_x1]
+        cv2.add(roi, colors, dst=roi)
+        
+        # Outside the box the heatmap is level 0, which adds the same offset everywhere
+        offset = get_heatmap_background_offset()
+        for strip in (frame[:roi_y0], frame[roi_y1:], frame[roi_y0:roi_y1, :roi_x0], frame[roi_y0:roi_y1, roi_x1:]):
+            if strip.size:
+                cv2.add(strip, offset, dst=strip)
+        return frame
+
+@functools.lru_cache(maxsize=8)
+def get_frame_compositor(w, h):
+    return FrameCompositor(w, h)
+
+class ClickColumns:
+    """Clicks held as float64 x, y and timestamp arrays instead of a list of dicts.
+    
+    len(), truthiness and iteration behave like the click list, so code written for
+    click_data lists keeps working, while click_arrays hands out the columns as they are.
+    """
+    
+    def __init__(self, x, y, timestamp):
+        self.x = np.asarray(x, dtype=np.float64)
+        self.y = np.asarray(y, dtype=np.float64)
+        self.timestamp = np.asarray(timestamp, dtype=np.float64)
+    
+    def __len__(self):
+        return len(self.x)
+    
+    def __iter__(self):
+        for x, y, t in zip(self.x.tolist(), self.y.tolist(), self.timestamp.tolist()):
+            yield {"x": x, "y": y, "timestamp": t}
+    
+    @classmethod
+    def concatenate(cls, click_lists):
+        """Join click lists and ClickColumns into one ClickColumns"""
+        columns = [click_arrays(clicks) for clicks in click_lists]
+        if not columns:
+            return cls(*click_arrays([]))
+        return cls(*(np.concatenate(column) for column in zip(*columns)))
+
+def click_arrays(click_data):
+    """Convert the click list to float64 x, y and timestamp arrays in one pass"""
+    if isinstance(click_data, ClickColumns):
+        return click_data.x, click_data.y, click_data.timestamp
+    
+    if not click_data:
+        empty = np.zeros(0, dtype=np.float64)
+        return empty, empty, empty
+    
+    columns = np.array([(click["x"], click["y"], click["timestamp"]) for click in click_data], dtype=np.float64)
+    return columns[:, 0], columns[:, 1], columns[:, 2]
+
+def reduce_pixel_events(keys, brightness, dtype=np.float32):
+    """Sum brightness per unique key, returning the sorted keys and their sums as dtype"""
+    unique_keys, inverse = np.unique(keys, return_inverse=True)
+    sums = np.bincount(inverse.ravel(), weights=brightness, minlength=len(unique_keys))
+    return unique_keys, sums.astype(dtype)
+
+def merge_pixel_events(keys, sums, other_keys, other_sums, sign=1):
+    """Add (sign=1) or subtract (sign=-1) one set of float64 per-key sums from another.
+    
+    Keys whose sum cancels out are dropped, so removing a contribution leaves no trace.
+    """
+    keys, sums = reduce_pixel_events(np.concatenate([keys, other_keys]), np.concatenate([sums, sign * other_sums]),
+                                     dtype=np.float64)
+    if sign < 0:
+        kept = np.abs(sums) > 1e-9
+        keys, sums = keys[kept], sums[kept]
+    return keys, sums
+
+def click_event_sums(click_data, w, h, fps, frame_count, fade_seconds=FADE_SECONDS):
+    """Unnormalised brightness of the click fade windows, summed per (frame * h + y) * w + x key.
+    
+    Each click lights its pixel over a fade-in/fade-out window around its timestamp.
+    All clicks are expanded to (frame, pixel, brightness) triples at once. Sums are
+    float64 so that contributions can be added and removed again exactly enough.
+    """
+    fade_duration = int(fps * fade_seconds)
+    click_x, click_y, click_t = click_arrays(click_data)
+    
+    xs = np.clip((click_x * w).astype(np.int64), 0, w - 1)
+    ys = np.clip((click_y * h).astype(np.int64), 0, h - 1)
+    
+    start_frames = np.maximum((click_t * fps - fade_duration).astype(np.int64), 0)
+    end_frames = np.minimum(start_frames + fade_duration * 2, frame_count)
+    lengths = np.maximum(end_frames - start_frames, 0)
+    
+    click_idx = np.repeat(np.arange(len(lengths)), lengths)
+    window_starts = np.cumsum(lengths) - lengths
+    frames = start_frames[click_idx] + np.arange(len(click_idx)) - window_starts[click_idx]
+    
+    start, end = start_frames[click_idx], end_frames[click_idx]
+    brightness = np.ones(len(frames), dtype=np.float32)
+    fade_in = frames < start + fade_duration
+    fade_out = frames >= end - fade_duration
+    brightness[fade_in] = (frames[fade_in] - start[fade_in]) / fade_duration
+    brightness[fade_out] = (end[fade_out] - frames[fade_out]) / fade_duration
+    
+    # The first frame of a fade-in is unlit and would never be drawn
+    lit = brightness > 0
+    keys = (frames[lit] * h + ys[click_idx[lit]]) * w + xs[click_idx[lit]]
+    return reduce_pixel_events(keys, brightness[lit], dtype=np.float64)
+
+def normalize_click_events(keys, sums, w, h):
+    """Turn click_event_sums output into sorted (frames, xs, ys, brightness) events.
+    
+    Brightness is normalised with the global sqrt(b / max) rule the dense per-frame
+    grid used.
+    """
+    brightness = sums.astype(np.float32)
+    if len(brightness) and np.max(brightness) > 1.0:
+        brightness = np.sqrt(brightness / np.max(brightness))
+    
+    frames, pixels = np.divmod(keys, h * w)
+    return frames, pixels % w, pixels // w, brightness
+
+def build_click_events(click_data, w, h, fps, frame_count, fade_seconds=FADE_SECONDS):
+    """Collect sparse (frames, xs, ys, brightness) events for the click fade windows.
+    
+    Brightness for the same frame and pixel is summed and the result is sorted by
+    frame, so memory scales with the number of clicks instead of frame_count * h * w.
+    """
+    return normalize_click_events(*click_event_sums(click_data, w, h, fps, frame_count, fade_seconds), w, h)
+
+def frame_brightness_points(frame_events, frame_idx):
+    """Slice one frame's (xs, ys, brightness) out of the sorted sparse events"""
+    frames, xs, ys, brightness = frame_events
+    lo, hi = np.searchsorted(frames, [frame_idx, frame_idx + 1])
+    return xs[lo:hi], ys[lo:hi], brightness[lo:hi]
+
+def final_click_counts(click_data, w, h):
+    """Clicks per y * w + x pixel key for the final aggregate frame, as float64 counts"""
+    click_x, click_y, _ = click_arrays(click_data)
+    xs, ys = (click_x * w).astype(np.int64), (click_y * h).astype(np.int64)
+    
+    inside = (xs >= 0) & (xs < w) & (ys >= 0) & (ys < h)
+    return reduce_pixel_events(ys[inside] * w + xs[inside], np.ones(np.count_nonzero(inside)), dtype=np.float64)
+
+def normalize_final_points(keys, counts, w):
+    """Turn final_click_counts output into (xs, ys, counts), sqrt-normalised like the per-frame events"""
+    counts = counts.astype(np.float32)
+    if len(counts) and np.max(counts) > 1.0:
+        counts = np.sqrt(counts / np.max(counts))
+    return keys % w, keys // w, counts
+
+def build_final_click_points(click_data, w, h):
+    """Click counts per pixel for the final aggregate frame, sqrt-normalised like the per-frame events"""
+    return normalize_final_points(*final_click_counts(click_data, w, h), w)
+
 def generate_filename(tracking_data, suffix=""):
     timestamp = tracking_data.get('timestamp', datetime.now().strftime("%Y%m%d_%H%M%S"))
     user_name = tracking_data.get('user_name', 'unknown_user').replace(' ', '_')
@@ -100,59 +656,554 @@ def generate_filename(tracking_data, suffix=""):
     
     return f"{base_name}{suffix}"
 
+def click_sidecar_path(json_path):
+    """Path of the columnar .npz written next to a tracking data JSON file"""
+    return os.path.splitext(json_path)[0] + ".npz"
+
+def save_click_sidecar(tracking_data, sidecar_path):
+    """Write tracking data as x/y/timestamp float64 arrays plus a JSON header of the other fields.
+    
+    The archive is uncompressed and holds no pickles, so loading it is a plain copy of the arrays.
+    """
+    metadata = {key: value for key, value in tracking_data.items() if key != 'click_data'}
+    click_x, click_y, click_t = click_arrays(tracking_data.get('click_data', []))
+    
+    temp_path = f"{sidecar_path}.{uuid.uuid4().hex}.tmp"
+    with open(temp_path, 'wb') as f:
+        np.savez(f, x=click_x, y=click_y, timestamp=click_t, metadata=np.array(json.dumps(metadata)))
+    os.replace(temp_path, sidecar_path)
+    return sidecar_path
+
+def load_click_sidecar(sidecar_path):
+    """Tracking data from a save_click_sidecar archive, with click_data as ClickColumns"""
+    with np.load(sidecar_path, allow_pickle=False) as stored:
+        data = json.loads(str(stored['metadata']))
+        data['click_data'] = ClickColumns(stored['x'], stored['y'], stored['timestamp'])
+    return data
+
+def load_tracking_file(json_path):
+    """Tracking data for a JSON file, read from its sidecar when that is at least as new as the JSON"""
+    sidecar_path = click_sidecar_path(json_path)
+    try:
+        if os.path.getmtime(sidecar_path) >= os.path.getmtime(json_path):
+            return load_click_sidecar(sidecar_path)
+    except (OSError, ValueError, KeyError):
+        pass
+    
+    with open(json_path, 'r') as f:
+        return json.load(f)
+
+def convert_tracking_files(root):
+    """Write missing or outdated sidecars for every tracking JSON file with click_data under root"""
+    converted = 0
+    for folder, _, _ in os.walk(root):
+        for json_file in sorted(glob.glob(os.path.join(folder, "*.json"))):
+            sidecar_path = click_sidecar_path(json_file)
+            if os.path.exists(sidecar_path) and os.path.getmtime(sidecar_path) >= os.path.getmtime(json_file):
+                continue
+            try:
+                with open(json_file, 'r') as f:
+                    data = json.load(f)
+                if isinstance(data, dict) and isinstance(data.get('click_data'), list):
+                    save_click_sidecar(data, sidecar_path)
+                    converted += 1
+            except Exception as e:
+                print(f"Error converting {json_file}: {e}")
+    
+    print(f"Converted {converted} tracking files under {root}")
+    return converted
+
 def save_tracking_data(tracking_data, filename_base):
+    """Write tracking data as indented JSON plus its columnar sidecar; returns the JSON path"""
     try:
         os.makedirs(OUTPUT_DIR, exist_ok=True)
         json_path = os.path.join(OUTPUT_DIR, f"{filename_base}_data.json")
         
+        click_data = tracking_data.get('click_data', [])
         with open(json_path, 'w') as f:
-            json.dump(tracking_data, f, indent=2)
+            json.dump({**tracking_data, 'click_data': list(click_data)}, f, indent=2)
         
+        save_click_sidecar(tracking_data, click_sidecar_path(json_path))
         return json_path
     except Exception as e:
         print(f"Error saving tracking data: {e}")
         return None
 
-def generate_averaged_heatmap(video_path, all_click_data, output_folder=None):
-    """Generate averaged heatmap by reusing existing generate_heatmap function"""
+def hash_file(path):
+    """SHA-256 hex digest of a file's bytes, remembered while its size and mtime stay the same"""
+    stat = os.stat(path)
+    return hash_file_contents(os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+@functools.lru_cache(maxsize=256)
+def hash_file_contents(path, size, mtime_ns, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def heatmap_cache_key(video_path, click_data, video_hash=None, click_digest=None):
+    """Content hash of everything the rendered video depends on.
+    
+    Clicks are reduced to sorted float64 (x, y, timestamp) rows, so their order and any
+    extra fields in the click dicts do not change the key. video_hash, if already known,
+    saves reading the video again, and click_digest, a caller's own hash of the clicks
+    (see ClickAggregate.cache_key), saves sorting them.
+    """
+    params = (HEATMAP_SIGMA, HEATMAP_BASE_RESOLUTION, FADE_SECONDS, MAX_RENDER_SIZE)
+    
+    digest = hashlib.sha256()
+    digest.update((video_hash or hash_file(video_path)).encode())
+    if click_digest:
+        digest.update(click_digest.encode())
+    else:
+        click_x, click_y, click_t = click_arrays(click_data)
+        order = np.lexsort((click_y, click_x, click_t))
+        clicks = np.ascontiguousarray(np.stack([click_x[order], click_y[order], click_t[order]], axis=1))
+        digest.update(clicks.tobytes())
+    digest.update(repr(params).encode())
+    return digest.hexdigest()
+
+def evict_oldest(entries, max_bytes, keep_path):
+    """Delete (mtime, size, path) entries oldest first until they fit in max_bytes; returns how many went.
+    
+    keep_path, the entry just added, stops the eviction rather than being deleted.
+    """
+    total = sum(size for _, size, _ in entries)
+    evicted = 0
+    for _, size, old_path in entries:
+        if total <= max_bytes or old_path == keep_path:
+            break
+        try:
+            os.unlink(old_path)
+            total -= size
+            evicted += 1
+        except OSError:
+            pass
+    return evicted
+
+class ResultCache:
+    """Disk cache of rendered heatmap videos, keyed by heatmap_cache_key.
+    
+    Entries are plain files in cache_dir; a hit refreshes the file's mtime, and puts
+    evict the oldest entries until the total size fits in max_bytes.
+    """
+    
+    def __init__(self, cache_dir=None, max_bytes=None):
+        self.cache_dir = cache_dir or CACHE_DIR
+        self.max_bytes = max_bytes or CACHE_MAX_BYTES
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def entry_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.mp4")
+    
+    def entries(self):
+        """(mtime, size, path) for every cached file, oldest first"""
+        entries = []
+        for path in glob.glob(os.path.join(self.cache_dir, "*.mp4")):
+            try:
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, path))
+            except OSError:
+                pass
+        return sorted(entries)
+    
+    def get(self, key):
+        """Path of the cached video for key, or None.
+        
+        Batch processes share the cache directory but not the lock, so an entry can be
+        evicted at any moment; callers must still expect the path to vanish.
+        """
+        path = self.entry_path(key)
+        with self.lock:
+            try:
+                os.utime(path)
+                self.hits += 1
+                return path
+            except FileNotFoundError:
+                self.misses += 1
+                return None
+    
+    def put(self, key, video_path):
+        """Copy video_path into the cache under key and evict down to max_bytes"""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self.entry_path(key)
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        shutil.copyfile(video_path, temp_path)
+        os.replace(temp_path, path)
+        
+        with self.lock:
+            self.evictions += evict_oldest(self.entries(), self.max_bytes, path)
+        return path
+    
+    def stats(self):
+        entries = self.entries()
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "entries": len(entries),
+                "size_bytes": sum(size for _, size, _ in entries),
+                "max_bytes": self.max_bytes
+            }
+
+result_cache = ResultCache()
+
+class FrameCache:
+    """Disk cache of the darkened, downscaled background frames of rendered videos.
+    
+    An entry is one raw uint8 file of frame_count x h x w x 3 bytes, named after the
+    video hash and its shape, and memory-mapped when read, so re-rendering the same
+    video with other clicks or settings reads frames instead of decoding them. As in
+    ResultCache, hits refresh the file's mtime and new entries evict the oldest ones
+    beyond max_bytes. Temp files that a crashed render left half written are deleted
+    once they have not changed for FRAME_CACHE_TEMP_SECONDS.
+    """
+    
+    def __init__(self, cache_dir=None, max_bytes=None):
+        self.cache_dir = cache_dir or FRAME_CACHE_DIR
+        self.max_bytes = max_bytes or FRAME_CACHE_MAX_BYTES
+        self.lock = threading.Lock()
+    
+    def entry_prefix(self, video_hash, frame_size):
+        w, h = frame_size
+        return os.path.join(self.cache_dir, f"{video_hash}_{w}x{h}x")
+    
+    def entries(self):
+        """(mtime, size, path) for every cached frame file, oldest first"""
+        entries = []
+        for path in glob.glob(os.path.join(self.cache_dir, "*.frames")):
+            try:
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, path))
+            except OSError:
+                pass
+        return sorted(entries)
+    
+    def get(self, video_hash, frame_size):
+        """Read-only (frame_count, h, w, 3) memmap of the cached frames, or None"""
+        w, h = frame_size
+        paths = glob.glob(glob.escape(self.entry_prefix(video_hash, frame_size)) + "*.frames")
+        for path in paths:
+            try:
+                frame_count = int(path.rsplit('x', 1)[1].split('.')[0])
+                frames = np.memmap(path, dtype=np.uint8, mode='r', shape=(frame_count, h, w, 3))
+                os.utime(path)
+                metrics.inc("heatmap_frame_cache_lookups_total", result="hit")
+                return frames
+            except (OSError, ValueError) as e:
+                print(f"Error reading cached frames {path}: {e}")
+        metrics.inc("heatmap_frame_cache_lookups_total", result="miss")
+        return None
+    
+    def writer(self, cap, video_hash, frame_size, frame_count):
+        """Wrap cap so the frames it decodes are darkened and stored, or None if they would not fit"""
+        w, h = frame_size
+        if frame_count * h * w * 3 > self.max_bytes:
+            return None
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.prune_temp_files()
+        return FrameCacheWriter(self, cap, video_hash, frame_size, frame_count)
+    
+    def prune_temp_files(self):
+        """Delete temp files no writer has touched for FRAME_CACHE_TEMP_SECONDS; live writers append every frame"""
+        cutoff = time.time() - FRAME_CACHE_TEMP_SECONDS
+        for path in glob.glob(os.path.join(self.cache_dir, "*.tmp")):
+            with contextlib.suppress(OSError):
+                if os.path.getmtime(path) < cutoff:
+                    os.unlink(path)
+    
+    def put(self, temp_path, video_hash, frame_size, frame_count):
+        """Move a finished frame file into place and evict down to max_bytes"""
+        path = f"{self.entry_prefix(video_hash, frame_size)}{frame_count}.frames"
+        os.replace(temp_path, path)
+        with self.lock:
+            evicted = evict_oldest(self.entries(), self.max_bytes, path)
+        if evicted:
+            metrics.inc("heatmap_frame_cache_evictions_total", evicted)
+        return path
+    
+    def stats(self):
+        entries = self.entries()
+        return {"entries": len(entries), "size_bytes": sum(size for _, size, _ in entries), "max_bytes": self.max_bytes}
+
+frame_cache = FrameCache()
+
+class FrameCacheWriter:
+    """cv2.VideoCapture-style reader that darkens cap's frames and appends them to a FrameCache entry.
+    
+    The entry is only stored on release if the video was read to its end, so a render
+    that fails partway leaves nothing behind. Errors writing the cache are reported and
+    do not interrupt the render.
+    """
+    
+    def __init__(self, cache, cap, video_hash, frame_size, frame_count):
+        self.cache = cache
+        self.cap = cap
+        self.video_hash = video_hash
+        self.frame_size = frame_size
+        self.expected = frame_count
+        self.count = 0
+        self.eof = False
+        self.temp_path = f"{cache.entry_prefix(video_hash, frame_size)}{uuid.uuid4().hex}.tmp"
+        self.file = open(self.temp_path, 'wb')
+    
+    def isOpened(self):
+        return self.cap.isOpened()
+    
+    def read(self, image=None):
+        ret, frame = self.cap.read(image)
+        if not ret:
+            self.eof = True
+            return ret, frame
+        
+        w, h = self.frame_size
+        if frame.shape[:2] != (h, w):
+            frame = cv2.resize(frame, (w, h), interpolation=cv2.INTER_AREA)
+        darken_frame(frame, frame)
+        if self.file:
+            try:
+                self.file.write(memoryview(np.ascontiguousarray(frame)).cast('B'))
+                self.count += 1
+            except OSError as e:
+                print(f"Error writing frame cache: {e}")
+                self.discard()
+        return True, frame
+    
+    def discard(self):
+        self.file.close()
+        self.file = None
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(self.temp_path)
+    
+    def release(self):
+        try:
+            self.cap.release()
+        except BaseException:
+            # A failed decode must not leave its temp file behind
+            if self.file:
+                self.discard()
+            raise
+        if not self.file:
+            return
+        if self.count and (self.eof or self.count >= self.expected):
+            self.file.close()
+            self.file = None
+            self.cache.put(self.temp_path, self.video_hash, self.frame_size, self.count)
+        else:
+            self.discard()
+
+class CachedFrameReader:
+    """cv2.VideoCapture-style reader over a FrameCache memmap, yielding darkened frames without decoding.
+    
+    Frames are copied out of the read-only map, into image when given, so they can be
+    composited in place.
+    """
+    
+    def __init__(self, frames):
+        self.frames = frames
+        self.index = 0
+    
+    def isOpened(self):
+        return self.frames is not None
+    
+    def read(self, image=None):
+        if self.index >= len(self.frames):
+            return False, None
+        frame = self.frames[self.index]
+        if image is None or image.shape != frame.shape:
+            image = np.empty(frame.shape, dtype=np.uint8)
+        np.copyto(image, frame)
+        self.index += 1
+        return True, image
+    
+    def release(self):
+        self.frames = None
+
+def load_participant_files(folder_path):
+    """(json_path, data) for every JSON file in the folder that carries click_data, sorted by path"""
+    participants = []
+    for json_file in sorted(glob.glob(os.path.join(folder_path, "*.json"))):
+        try:
+            data = load_tracking_file(json_file)
+            
+            if isinstance(data, dict) and isinstance(data.get('click_data'), (list, ClickColumns)):
+                participants.append((json_file, data))
+        except Exception as e:
+            print(f"Error processing {json_file}: {e}")
+    
+    print(f"Loaded {len(participants)} participant files from {folder_path}")
+    return participants
+
+def load_json_files(folder_path):
+    """All clicks from the folder's participant JSON files, merged into one ClickColumns"""
+    return ClickColumns.concatenate(data['click_data'] for _, data in load_participant_files(folder_path))
+
+class ClickAggregate:
+    """Persisted sum of a study's participant click contributions, updated only for files that changed.
+    
+    Kept per study folder and video; contributions are stored per file hash and render
+    geometry, and update() holds a lock on the directory while it changes the totals.
+    """
+    
+    def __init__(self, video_path, folder_path, aggregate_dir=None):
+        self.video_hash = hash_file(video_path)
+        folder_key = hashlib.sha256(os.path.abspath(folder_path).encode()).hexdigest()[:16]
+        self.directory = os.path.join(aggregate_dir or AGGREGATE_DIR, f"{folder_key}_{self.video_hash}")
+        self.totals_path = os.path.join(self.directory, "totals.npz")
+    
+    def contribution_path(self, digest, geometry):
+        """Contributions are per geometry, since their pixel keys and frame windows depend on it"""
+        geometry_key = hashlib.sha256(json.dumps(geometry, sort_keys=True).encode()).hexdigest()[:16]
+        return os.path.join(self.directory, "participants", geometry_key, f"{digest}.npz")
+    
+    @contextlib.contextmanager
+    def locked(self):
+        """Hold an exclusive lock on the aggregate directory, across threads and processes"""
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, ".lock"), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+    
+    def save_arrays(self, path, parts, **extra):
+        """Write (event_keys, event_sums, final_keys, final_counts) and any extra arrays to path through a temp file"""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(temp_path, 'wb') as f:
+            np.savez(f, event_keys=parts[0], event_sums=parts[1], final_keys=parts[2], final_counts=parts[3], **extra)
+        os.replace(temp_path, path)
+    
+    def cache_key(self, participant_files):
+        """heatmap_cache_key of the averaged render, from the participant file hashes instead of their clicks"""
+        digest = hashlib.sha256(b"participants")
+        for file_digest in sorted(hash_file(path) for path, _ in participant_files):
+            digest.update(file_digest.encode())
+        return heatmap_cache_key(None, None, self.video_hash, click_digest=digest.hexdigest())
+    
+    def load(self, geometry):
+        """Manifest and totals on disk, or empty ones if missing or made for another geometry"""
+        empty_keys, empty_sums = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64)
+        totals = [empty_keys, empty_sums, empty_keys, empty_sums]
+        try:
+            with np.load(self.totals_path, allow_pickle=False) as stored:
+                manifest = json.loads(str(stored['manifest']))
+                if manifest.get('geometry') == geometry:
+                    totals = [stored[name] for name in ('event_keys', 'event_sums', 'final_keys', 'final_counts')]
+                    return manifest['participants'], totals
+        except (OSError, ValueError, KeyError):
+            pass
+        return {}, totals
+    
+    def stored_contribution(self, digest, geometry):
+        """A participant's saved (event_keys, event_sums, final_keys, final_counts) for geometry, or None"""
+        try:
+            with np.load(self.contribution_path(digest, geometry)) as stored:
+                return [stored[name] for name in ('event_keys', 'event_sums', 'final_keys', 'final_counts')]
+        except (OSError, ValueError, KeyError):
+            return None
+    
+    def contribution(self, digest, data, geometry):
+        """One participant's contribution, computed once per file hash and geometry"""
+        parts = self.stored_contribution(digest, geometry)
+        if parts is not None:
+            return parts
+        
+        click_data = data['click_data']
+        w, h = geometry['width'], geometry['height']
+        parts = [*click_event_sums(click_data, w, h, geometry['fps'], geometry['frame_count']),
+                 *final_click_counts(click_data, w, h)]
+        self.save_arrays(self.contribution_path(digest, geometry), parts)
+        return parts
+    
+    def update(self, participant_files, w, h, fps, frame_count):
+        """Bring the totals in line with participant_files and return (frame_events, final_points)"""
+        with self.locked():
+            return self.update_locked(participant_files, w, h, fps, frame_count)
+    
+    def update_locked(self, participant_files, w, h, fps, frame_count):
+        geometry = {"width": w, "height": h, "fps": fps, "frame_count": frame_count, "fade_seconds": FADE_SECONDS}
+        included, totals = self.load(geometry)
+        current = {os.path.basename(path): (hash_file(path), data) for path, data in participant_files}
+        
+        removed = [name for name, digest in included.items() if current.get(name, (None,))[0] != digest]
+        added = [name for name, (digest, _) in current.items() if included.get(name) != digest]
+        
+        stale = [self.stored_contribution(included[name], geometry) for name in removed]
+        if any(parts is None for parts in stale):
+            # A contribution to subtract is gone, so start over from the current files
+            included, totals = self.load(None)
+            removed, stale = [], []
+            added = list(current)
+        
+        for name, parts in zip(removed, stale):
+            del included[name]
+            totals[0:2] = merge_pixel_events(*totals[0:2], *parts[0:2], sign=-1)
+            totals[2:4] = merge_pixel_events(*totals[2:4], *parts[2:4], sign=-1)
+        
+        for name in added:
+            digest, data = current[name]
+            parts = self.contribution(digest, data, geometry)
+            totals[0:2] = merge_pixel_events(*totals[0:2], *parts[0:2])
+            totals[2:4] = merge_pixel_events(*totals[2:4], *parts[2:4])
+            included[name] = digest
+        
+        if removed or added or not os.path.exists(self.totals_path):
+            print(f"Click aggregate: {len(added)} participants added, {len(removed)} removed")
+            manifest = {"geometry": geometry, "participants": included}
+            self.save_arrays(self.totals_path, totals, manifest=np.array(json.dumps(manifest)))
+        
+        return normalize_click_events(totals[0], totals[1], w, h), normalize_final_points(totals[2], totals[3], w)
+
+def generate_averaged_heatmap(video_path, participant_files, output_folder=None):
+    """Generate averaged heatmap by reusing existing generate_heatmap function.
+    
+    Click events and the result cache key come from the study's ClickAggregate, so only
+    participant files that changed since the last run are re-processed before the video
+    is re-composited, and the merged clicks are never concatenated, sorted or saved.
+    """
     if output_folder is None:
         output_folder = OUTPUT_DIR
     
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     
-    # Create fake tracking_data that mimics the expected format
+    # Create fake tracking_data that mimics the expected format; the unique timestamp keeps
+    # the scratch render of concurrent batch workers from sharing a path
     tracking_data = {
-        'click_data': all_click_data,
+        'click_count': sum(len(data['click_data']) for _, data in participant_files),
         'user_name': 'averaged',
         'tracking_type': 'heatmap',
-        'timestamp': timestamp
+        'timestamp': f"{timestamp}_{uuid.uuid4().hex[:8]}"
     }
     
-    # Use existing generate_heatmap function
-    temp_output = generate_heatmap(video_path, tracking_data)
+    aggregate = ClickAggregate(video_path, os.path.dirname(os.path.abspath(video_path)))
+    
+    # Use existing generate_heatmap function, skipping the render if this video and click set were done before
+    temp_output = generate_heatmap_cached(video_path, tracking_data, output_dir=output_folder, save_data=False,
+                                          cache_key=aggregate.cache_key(participant_files),
+                                          events=lambda w, h, fps, frame_count: aggregate.update(participant_files, w, h, fps, frame_count))
     
     if temp_output and os.path.exists(temp_output):
         # Move to final location with timestamped name
         final_video_path = os.path.join(output_folder, f"averaged_heatmap_{timestamp}.mp4")
         shutil.move(temp_output, final_video_path)
         
-        # Load data from original JSON files
-        folder_path = os.path.dirname(video_path)
-        participants = []
-        
-        for json_file in glob.glob(os.path.join(folder_path, "*.json")):
-            try:
-                with open(json_file, 'r') as f:
-                    data = json.load(f)
-                
-                if 'user_name' in data and 'precision_score' in data and 'click_data' in data:
-                    participants.append({
-                        "user_name": data['user_name'],
-                        "click_count": len(data['click_data']),
-                        "precision_score": data['precision_score']
-                    })
-            except Exception as e:
-                print(f"Error processing {json_file}: {e}")
+        participants = [
+            {
+                "user_name": data['user_name'],
+                "click_count": len(data['click_data']),
+                "precision_score": data['precision_score']
+            }
+            for _, data in participant_files if 'user_name' in data and 'precision_score' in data
+        ]
         
         summary_data = {
             "participant_count": len(participants),
@@ -169,18 +1220,232 @@ def generate_averaged_heatmap(video_path, all_click_data, output_folder=None):
         print(f"Averaged heatmap generated: {final_video_path}")
         return final_video_path
     
+    # Drop a partial render so it is not taken for this folder's output later
+    with contextlib.suppress(FileNotFoundError):
+        os.unlink(os.path.join(output_folder, f"{generate_filename(tracking_data)}_heatmap.mp4"))
     return None
 
-def process_folder(folder_path):
+class AreaOfInterest:
+    """A named rectangle or polygon in normalised video coordinates, like click x/y, optionally limited to start-end seconds"""
+    
+    def __init__(self, name, polygon=None, rect=None, start=None, end=None):
+        if (polygon is None) == (rect is None):
+            raise ValueError(f"AOI {name!r} needs exactly one of rect or polygon")
+        self.name = name
+        self.rect = None if rect is None else tuple(float(v) for v in rect)
+        self.polygon = None if polygon is None else np.asarray(polygon, dtype=np.float64)
+        self.start = None if start is None else float(start)
+        self.end = None if end is None else float(end)
+        
+        if self.rect is not None and (len(self.rect) != 4 or self.rect[0] >= self.rect[2] or self.rect[1] >= self.rect[3]):
+            raise ValueError(f"AOI {name!r} rect must be [x0, y0, x1, y1] with x0 < x1 and y0 < y1")
+        if self.polygon is not None and (self.polygon.ndim != 2 or self.polygon.shape[1] != 2 or len(self.polygon) < 3):
+            raise ValueError(f"AOI {name!r} polygon needs at least three [x, y] points")
+        if self.start is not None and self.end is not None and self.start >= self.end:
+            raise ValueError(f"AOI {name!r} start must be before its end")
+    
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['name'], data.get('polygon'), data.get('rect'), data.get('start'), data.get('end'))
+    
+    def to_dict(self):
+        shape = {"rect": list(self.rect)} if self.rect is not None else {"polygon": self.polygon.tolist()}
+        return {"name": self.name, **shape, "start": self.start, "end": self.end}
+    
+    def bounds(self):
+        if self.rect is not None:
+            return self.rect
+        (x0, y0), (x1, y1) = self.polygon.min(axis=0), self.polygon.max(axis=0)
+        return x0, y0, x1, y1
+    
+    def contains(self, xs, ys):
+        """Mask of the points inside; rectangles include their top-left edges, polygons use the even-odd rule"""
+        if self.rect is not None:
+            x0, y0, x1, y1 = self.rect
+            return (xs >= x0) & (xs < x1) & (ys >= y0) & (ys < y1)
+        
+        inside = np.zeros(len(xs), dtype=bool)
+        for (ax, ay), (bx, by) in zip(self.polygon, np.roll(self.polygon, 1, axis=0)):
+            crosses = (ay > ys) != (by > ys)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                edge_x = ax + (ys - ay) * (bx - ax) / (by - ay)
+            inside ^= crosses & (xs < edge_x)
+        return inside
+
+def load_aoi_definitions(source):
+    """AreaOfInterest list from a JSON file path, or from already parsed {"aois": [...]} or [...] data"""
+    if isinstance(source, str):
+        with open(source, 'r') as f:
+            source = json.load(f)
+    entries = source.get('aois', []) if isinstance(source, dict) else source
+    
+    aois = [AreaOfInterest.from_dict(entry) for entry in entries]
+    names = [aoi.name for aoi in aois]
+    if len(set(names)) != len(names):
+        raise ValueError("AOI names must be unique")
+    return aois
+
+class AOIIndex:
+    """Uniform grid over the unit square listing the AOIs whose bounding box touches each cell.
+    
+    A click is only tested against the AOIs of its cell, and time windows are checked
+    on those candidates, so the work grows with the number of clicks and how many AOIs
+    overlap where they land, not with clicks x AOIs.
+    """
+    
+    def __init__(self, aois, grid_size=None):
+        self.aois = aois
+        self.grid_size = grid = grid_size or AOI_GRID_SIZE
+        self.starts = np.array([-np.inf if aoi.start is None else aoi.start for aoi in aois])
+        self.ends = np.array([np.inf if aoi.end is None else aoi.end for aoi in aois])
+        self.boxes = np.array([aoi.bounds() for aoi in aois], dtype=np.float64).reshape(-1, 4)
+        self.polygons = np.array([aoi.polygon is not None for aoi in aois], dtype=bool)
+        
+        cells, members = [], []
+        for i, aoi in enumerate(aois):
+            x0, y0, x1, y1 = (min(max(int(v * grid), 0), grid - 1) for v in aoi.bounds())
+            cx, cy = np.meshgrid(np.arange(x0, x1 + 1), np.arange(y0, y1 + 1))
+            cells.append((cy * grid + cx).ravel())
+            members.append(np.full(cx.size, i))
+        cells = np.concatenate(cells) if cells else np.zeros(0, dtype=np.int64)
+        members = np.concatenate(members) if members else np.zeros(0, dtype=np.int64)
+        
+        order = np.argsort(cells, kind='stable')
+        self.cell_aois = members[order]
+        self.cell_counts = np.bincount(cells, minlength=grid * grid)
+        self.cell_starts = np.cumsum(self.cell_counts) - self.cell_counts
+    
+    def hits(self, xs, ys, ts):
+        """(click_indices, aoi_indices) of every click inside an AOI during its time window, grouped by click"""
+        grid = self.grid_size
+        cx = np.clip((xs * grid).astype(np.int64), 0, grid - 1)
+        cy = np.clip((ys * grid).astype(np.int64), 0, grid - 1)
+        counts = self.cell_counts[cy * grid + cx]
+        
+        # Expand every click into one candidate pair per AOI listed in its cell
+        clicks = np.repeat(np.arange(len(xs)), counts)
+        within = np.arange(len(clicks)) - np.repeat(np.cumsum(counts) - counts, counts)
+        candidates = self.cell_aois[self.cell_starts[cy * grid + cx][clicks] + within]
+        
+        # Time windows and bounding boxes for all pairs at once; a rectangle's box is exact
+        box = self.boxes[candidates]
+        px, py = xs[clicks], ys[clicks]
+        keep = ((ts[clicks] >= self.starts[candidates]) & (ts[clicks] < self.ends[candidates]) &
+                (px >= box[:, 0]) & (px < box[:, 2]) & (py >= box[:, 1]) & (py < box[:, 3]))
+        clicks, candidates = clicks[keep], candidates[keep]
+        
+        # Only polygons need the exact test, one AOI at a time
+        inside = ~self.polygons[candidates]
+        pending = np.flatnonzero(~inside)
+        pending = pending[np.argsort(candidates[pending], kind='stable')]
+        bounds = np.searchsorted(candidates[pending], np.arange(len(self.aois) + 1))
+        for i in np.flatnonzero(self.polygons):
+            chunk = pending[bounds[i]:bounds[i + 1]]
+            if len(chunk):
+                inside[chunk] = self.aois[i].contains(xs[clicks[chunk]], ys[clicks[chunk]])
+        return clicks[inside], candidates[inside]
+
+def compute_aoi_stats(aois, participants, max_sample_seconds=None):
+    """Hits, dwell time, visits and time to first hit per participant and AOI, plus per-AOI totals.
+    
+    participants is a list of (label, tracking_data). A click's dwell is the time until
+    the participant's next click, at most max_sample_seconds; a visit is a run of
+    consecutive clicks inside the same AOI. Time to first hit counts from the AOI's
+    start, or from 0. All participants go through one AOIIndex query.
+    """
+    max_sample_seconds = max_sample_seconds or AOI_MAX_SAMPLE_SECONDS
+    index = AOIIndex(aois)
+    
+    xs, ys, ts, durations, owners = [], [], [], [], []
+    for p, (_, data) in enumerate(participants):
+        click_x, click_y, click_t = click_arrays(data.get('click_data', []))
+        order = np.argsort(click_t, kind='stable')
+        click_t = click_t[order]
+        xs.append(click_x[order])
+        ys.append(click_y[order])
+        ts.append(click_t)
+        durations.append(np.minimum(np.diff(click_t, append=click_t[-1:]), max_sample_seconds))
+        owners.append(np.full(len(click_t), p))
+    xs, ys, ts, durations, owners = (np.concatenate(a) if a else np.zeros(0) for a in (xs, ys, ts, durations, owners))
+    owners = owners.astype(np.int64)
+    
+    clicks, hit_aois = index.hits(xs, ys, ts)
+    
+    # Group hits by participant and AOI, keeping each group in time order
+    groups = owners[clicks] * len(aois) + hit_aois
+    order = np.lexsort((clicks, groups))
+    clicks, groups = clicks[order], groups[order]
+    size = len(participants) * len(aois)
+    
+    hits = np.bincount(groups, minlength=size)
+    dwell = np.bincount(groups, weights=durations[clicks], minlength=size)
+    new_visit = np.ones(len(clicks), dtype=bool)
+    new_visit[1:] = (groups[1:] != groups[:-1]) | (clicks[1:] != clicks[:-1] + 1)
+    visits = np.bincount(groups[new_visit], minlength=size)
+    first_hit = np.full(size, np.nan)
+    first = np.unique(groups, return_index=True)[1]
+    first_hit[groups[first]] = ts[clicks[first]] - np.maximum(index.starts[groups[first] % len(aois)], 0.0)
+    
+    def aoi_record(g):
+        return {"hits": int(hits[g]), "dwell_seconds": round(float(dwell[g]), 4), "visits": int(visits[g]),
+                "time_to_first_hit": None if np.isnan(first_hit[g]) else round(float(first_hit[g]), 4)}
+    
+    records = []
+    for p, (label, data) in enumerate(participants):
+        records.append({
+            "participant": data.get('user_name', os.path.splitext(os.path.basename(label))[0]),
+            "source": label,
+            "click_count": int(np.count_nonzero(owners == p)),
+            "aois": {aoi.name: aoi_record(p * len(aois) + a) for a, aoi in enumerate(aois)}
+        })
+    
+    summary = {}
+    for a, aoi in enumerate(aois):
+        per_participant = np.arange(len(participants)) * len(aois) + a
+        firsts = first_hit[per_participant]
+        firsts = firsts[~np.isnan(firsts)]
+        summary[aoi.name] = {
+            "hits": int(hits[per_participant].sum()),
+            "dwell_seconds": round(float(dwell[per_participant].sum()), 4),
+            "mean_dwell_seconds": round(float(dwell[per_participant].mean()), 4) if len(participants) else 0.0,
+            "visits": int(visits[per_participant].sum()),
+            "participants_hit": int(len(firsts)),
+            "mean_time_to_first_hit": round(float(firsts.mean()), 4) if len(firsts) else None,
+            "median_time_to_first_hit": round(float(np.median(firsts)), 4) if len(firsts) else None
+        }
+    
+    return {"aois": [aoi.to_dict() for aoi in aois], "participant_count": len(participants),
+            "max_sample_seconds": max_sample_seconds, "participants": records, "summary": summary}
+
+def write_aoi_stats(stats, output_folder, filename_base):
+    """Write AOI stats as JSON and as a participant x AOI CSV table; returns both paths"""
+    os.makedirs(output_folder, exist_ok=True)
+    json_path = os.path.join(output_folder, f"{filename_base}.json")
+    csv_path = os.path.join(output_folder, f"{filename_base}.csv")
+    
+    with open(json_path, 'w') as f:
+        json.dump(stats, f, indent=2)
+    
+    with open(csv_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(["participant", "source", "aoi", "hits", "dwell_seconds", "visits", "time_to_first_hit"])
+        for record in stats["participants"]:
+            for name, values in record["aois"].items():
+                writer.writerow([record["participant"], record["source"], name, values["hits"], values["dwell_seconds"],
+                                 values["visits"], "" if values["time_to_first_hit"] is None else values["time_to_first_hit"]])
+    return json_path, csv_path
+
+def process_folder(folder_path, output_folder=None):
     """Process a folder containing JSON files and video to generate averaged heatmap"""    
+    output_folder = output_folder or OUTPUT_DIR
     if not os.path.exists(folder_path):
         print(f"Error: Folder {folder_path} does not exist")
         return None
     
     # Load all JSON files
-    all_click_data = load_json_files(folder_path)
+    participant_files = load_participant_files(folder_path)
     
-    if not all_click_data:
+    if not any(data['click_data'] for _, data in participant_files):
         print("No valid click data found in JSON files")
         return None
     
@@ -191,166 +1456,772 @@ def process_folder(folder_path):
         print("No video file found in folder")
         return None
     
-    # Generate averaged heatmap
-    output_path = generate_averaged_heatmap(video_path, all_click_data, OUTPUT_DIR)
+    # Generate averaged heatmap
+    os.makedirs(output_folder, exist_ok=True)
+    output_path = generate_averaged_heatmap(video_path, participant_files, output_folder)
+    
+    if output_path:
+        print(f"Successfully generated averaged heatmap: {output_path}")
+        return output_path
+    else:
+        print("Failed to generate averaged heatmap")
+        return None
+
+def process_folder_static(folder_path, start=None, end=None, output_folder=None):
+    """Static aggregate heatmap image and density for every participant in a study folder"""
+    click_data = load_json_files(folder_path)
+    video_path = find_video_file(folder_path)
+    if not video_path or not len(click_data):
+        print("Need a video and click data to generate a static heatmap")
+        return None
+    
+    tracking_data = {
+        'click_data': click_data,
+        'user_name': 'averaged',
+        'tracking_type': 'static',
+        'timestamp': datetime.now().strftime("%Y%m%d_%H%M%S")
+    }
+    return generate_static_heatmap(video_path, tracking_data, start, end, output_folder)
+
+def process_folder_aoi(folder_path, aoi_path=None, output_folder=None):
+    """AOI statistics for every participant in a study folder; AOIs come from aoi_path or the folder's aois.json"""
+    aoi_path = aoi_path or os.path.join(folder_path, "aois.json")
+    if not os.path.exists(aoi_path):
+        print(f"Error: AOI definitions {aoi_path} do not exist")
+        return None
+    
+    try:
+        aois = load_aoi_definitions(aoi_path)
+    except (ValueError, KeyError, TypeError) as e:
+        print(f"Error: invalid AOI definitions in {aoi_path}: {e}")
+        return None
+    
+    participant_files = load_participant_files(folder_path)
+    if not participant_files:
+        print("No valid click data found in JSON files")
+        return None
+    
+    stats = compute_aoi_stats(aois, participant_files)
+    video_path = find_video_file(folder_path)
+    stats["video"] = os.path.basename(video_path) if video_path else None
+    
+    json_path, csv_path = write_aoi_stats(stats, output_folder or OUTPUT_DIR,
+                                          f"aoi_stats_{datetime.now().strftime('%Y%m%d_%H%M%S')}")
+    print(f"AOI statistics for {len(aois)} areas and {len(participant_files)} participants: {json_path}, {csv_path}")
+    return json_path
+
+def is_study_folder(folder_path):
+    """Whether the folder holds a video and at least one JSON file"""
+    has_video = any(glob.glob(os.path.join(folder_path, ext)) for ext in VIDEO_EXTENSIONS)
+    return has_video and bool(glob.glob(os.path.join(folder_path, "*.json")))
+
+def find_study_folders(source):
+    """Study folders listed in a manifest file, or found anywhere under a root directory.
+    
+    A manifest is a JSON list of paths or a text file with one path per line; blank
+    lines and lines starting with # are ignored, and relative paths are resolved
+    against the manifest's directory.
+    """
+    if os.path.isdir(source):
+        return sorted(root for root, _, _ in os.walk(source) if is_study_folder(root))
+    
+    with open(source, 'r') as f:
+        if source.endswith('.json'):
+            entries = json.load(f)
+        else:
+            entries = [line.strip() for line in f if line.strip() and not line.lstrip().startswith('#')]
+    
+    base = os.path.dirname(os.path.abspath(source))
+    return [os.path.normpath(os.path.join(base, os.path.expanduser(entry))) for entry in entries]
+
+def folder_is_up_to_date(folder_path, output_folder):
+    """Whether output_folder has an averaged heatmap newer than every video and JSON file in folder_path"""
+    outputs = glob.glob(os.path.join(output_folder, "averaged_heatmap_*.mp4"))
+    inputs = [path for ext in VIDEO_EXTENSIONS + ['*.json'] for path in glob.glob(os.path.join(folder_path, ext))]
+    if not outputs or not inputs:
+        return False
+    return max(os.path.getmtime(path) for path in outputs) > max(os.path.getmtime(path) for path in inputs)
+
+def init_batch_worker(render_workers, render_processes, frame_cache_enabled):
+    """Split the machine between batch workers; globals set in main() do not reach spawned processes"""
+    global RENDER_WORKERS, RENDER_PROCESSES, FRAME_CACHE_ENABLED
+    RENDER_WORKERS = render_workers
+    RENDER_PROCESSES = render_processes
+    FRAME_CACHE_ENABLED = frame_cache_enabled
+
+def process_batch_folder(folder_path, output_folder):
+    """process_folder for one batch entry, returning its summary record"""
+    start = time.time()
+    record = {"folder": folder_path, "output_folder": output_folder}
+    try:
+        output_path = process_folder(folder_path, output_folder)
+        record.update(status="done" if output_path else "failed", output=output_path)
+        if not output_path:
+            record["error"] = "Processing failed"
+    except Exception as e:
+        record.update(status="failed", output=None, error=str(e))
+    record["seconds"] = round(time.time() - start, 3)
+    return record
+
+def process_batch(source, workers=None, output_root=None, summary_path=None, force=False):
+    """Generate averaged heatmaps for many study folders in a process pool.
+    
+    Each folder's results go to output_root/<path relative to the folders' common
+    root>. Folders whose outputs are newer than their inputs are skipped unless force
+    is set. A JSON summary of per-folder status and timings is written to
+    summary_path and returned.
+    """
+    start = time.time()
+    output_root = output_root or OUTPUT_DIR
+    workers = max(1, workers or os.cpu_count() or 1)
+    folders = [os.path.abspath(folder) for folder in find_study_folders(source)]
+    common_root = os.path.commonpath(folders) if len(folders) > 1 else os.path.dirname(folders[0]) if folders else ""
+    print(f"Batch: {len(folders)} study folders, {workers} workers")
+    
+    records = []
+    pending = {}
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_batch_worker,
+                             initargs=(max(1, RENDER_WORKERS // workers), RENDER_PROCESSES, FRAME_CACHE_ENABLED)) as pool:
+        for folder in folders:
+            output_folder = os.path.join(output_root, os.path.relpath(folder, common_root))
+            if not force and folder_is_up_to_date(folder, output_folder):
+                records.append({"folder": folder, "output_folder": output_folder, "status": "skipped", "seconds": 0.0})
+                continue
+            pending[pool.submit(process_batch_folder, folder, output_folder)] = folder
+        
+        for future in pending:
+            try:
+                records.append(future.result())
+            except Exception as e:
+                records.append({"folder": pending[future], "status": "failed", "error": str(e), "seconds": None})
+            print(f"Batch: {len(records)}/{len(folders)} folders finished")
+    
+    summary = {
+        "source": os.path.abspath(source),
+        "workers": workers,
+        "seconds": round(time.time() - start, 3),
+        "counts": {status: sum(r["status"] == status for r in records) for status in ("done", "skipped", "failed")},
+        "folders": sorted(records, key=lambda r: r["folder"])
+    }
+    
+    summary_path = summary_path or os.path.join(output_root, f"batch_summary_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(summary_path)), exist_ok=True)
+    with open(summary_path, 'w') as f:
+        json.dump(summary, f, indent=2)
+    print(f"Batch summary written to {summary_path}")
+    return summary
+
+def merge_audio(temp_video_path, audio_source, output_path, stats=None):
+    """Re-encode the OpenCV temp video to output_path, muxing in the audio of audio_source if it has any"""
+    if has_audio_stream(audio_source, stats):
+        # Get duration of temp video to ensure audio sync
+        duration_cmd = ['ffprobe', '-v', 'quiet', '-show_entries', 'format=duration', '-of', 'csv=p=0', temp_video_path]
+        try:
+            duration_result = subprocess.run(duration_cmd, capture_output=True, text=True)
+            temp_duration = float(duration_result.stdout.strip())
+            
+            # Merge video with audio
+            merge_cmd = [
+                'ffmpeg', '-i', temp_video_path, '-i', audio_source,
+                '-c:v', 'libx264', '-c:a', 'aac', '-map', '0:v:0', '-map', '1:a:0',
+                '-t', str(temp_duration), 
+                '-y', output_path
+            ]
+            result = subprocess.run(merge_cmd, capture_output=True)
+            if result.returncode == 0:
+                os.unlink(temp_video_path)
+                print("Audio merged successfully")
+            else:
+                record_fallback('audio_merge', result.stderr.decode() if result.stderr else 'Unknown error', stats)
+                shutil.move(temp_video_path, output_path)
+        
+        except Exception as e:
+            record_fallback('audio_merge', e, stats)
+            shutil.move(temp_video_path, output_path)
+    else:
+        print("No audio found in original video")
+        shutil.move(temp_video_path, output_path)
+
+def hls_output_args(hls_dir, playlist_type='event'):
+    """ffmpeg output options that write HLS segments and a playlist into hls_dir.
+    
+    An event playlist is rewritten after every finished segment, so players can start
+    on the first segment while later ones are still being encoded.
+    """
+    return ['-f', 'hls', '-hls_time', str(HLS_SEGMENT_SECONDS), '-hls_playlist_type', playlist_type,
+            '-hls_segment_filename', os.path.join(hls_dir, 'segment_%05d.ts'), '-y', os.path.join(hls_dir, HLS_PLAYLIST)]
+
+def remux(input_path, output_args):
+    """Copy input_path's streams to the output described by output_args without re-encoding"""
+    cmd = ['ffmpeg', '-loglevel', 'error', '-i', input_path, '-c', 'copy'] + output_args
+    result = subprocess.run(cmd, capture_output=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg remux failed: {result.stderr.decode(errors='replace').strip()}")
+
+def hls_to_mp4(hls_dir, output_path):
+    """Join a finished HLS playlist's segments into an MP4"""
+    remux(os.path.join(hls_dir, HLS_PLAYLIST), ['-bsf:a', 'aac_adtstoasc', '-y', output_path])
+
+def mp4_to_hls(video_path, hls_dir):
+    """Split an already rendered video into HLS segments, cut at its existing keyframes"""
+    remux(video_path, hls_output_args(hls_dir, playlist_type='vod'))
+
+class FFmpegPipeWriter:
+    """cv2.VideoWriter-compatible writer that streams raw BGR frames into a single ffmpeg encode.
+    
+    If audio_source has an audio stream it is muxed in the same pass, cut to max_duration
+    seconds, so no temp video or separate audio merge encode is needed. With hls_dir the
+    encode goes to HLS segments there instead of to output_path, with a keyframe at
+    every segment boundary.
+    """
+    
+    def __init__(self, output_path, fps, frame_size, audio_source=None, max_duration=None, crf=23, preset='veryfast',
+                 hls_dir=None):
+        w, h = frame_size
+        cmd = ['ffmpeg', '-loglevel', 'error', '-f', 'rawvideo', '-pix_fmt', 'bgr24',
+               '-s', f'{w}x{h}', '-r', str(fps), '-i', '-']
+        if audio_source:
+            cmd += ['-i', audio_source, '-map', '0:v:0', '-map', '1:a:0?', '-c:a', 'aac']
+        if max_duration:
+            cmd += ['-t', f'{max_duration:.3f}']
+        if w % 2 or h % 2:
+            cmd += ['-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2']
+        cmd += ['-c:v', 'libx264', '-preset', preset, '-crf', str(crf), '-pix_fmt', 'yuv420p']
+        if hls_dir:
+            cmd += ['-force_key_frames', f'expr:gte(t,n_forced*{HLS_SEGMENT_SECONDS})'] + hls_output_args(hls_dir)
+        else:
+            cmd += ['-y', output_path]
+        
+        self.process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+    
+    def isOpened(self):
+        return self.process.poll() is None
+    
+    def write(self, frame):
+        self.process.stdin.write(memoryview(np.ascontiguousarray(frame)).cast('B'))
+    
+    def release(self):
+        if self.process.stdin.closed:
+            return
+        self.process.stdin.close()
+        stderr = self.process.stderr.read()
+        if self.process.wait() != 0:
+            raise RuntimeError(f"ffmpeg encode failed: {stderr.decode(errors='replace').strip()}")
+
+def render_pipeline(cap, out, render_frame, frame_count, workers=None, decode_depth=None, encode_depth=None, batch_size=50,
+                    progress=None, stats=None):
+    """Decode, render and encode frames concurrently, keeping frame order.
+    
+    A decoder thread reads frames from cap into a bounded queue, a pool of workers runs
+    render_frame(idx, frame), and an encoder thread writes the results to out in order.
+    Futures are queued in submission order and the queues are bounded, so at most
+    decode_depth + encode_depth frames are in flight. render_frame may draw on the
+    frame it is given, and frames are handed back to cap.read once written, so
+    decoding reuses that fixed set of buffers. Every batch_size frames the written
+    fraction is passed to progress, if given. With stats, time spent in decode,
+    overlay and encode is recorded. Returns a copy of the last decoded frame, as
+    decoded.
+    """
+    workers = workers or RENDER_WORKERS
+    stats = stats or RenderStats()
+    
+    def timed_render(idx, frame):
+        with stats.stage('overlay'):
+            return render_frame(idx, frame)
+    decode_queue = queue.Queue(maxsize=decode_depth or DECODE_QUEUE_DEPTH)
+    encode_queue = queue.Queue(maxsize=encode_depth or ENCODE_QUEUE_DEPTH)
+    free_frames = queue.SimpleQueue()
+    stop = threading.Event()
+    errors = []
+    last_frame = None
+    
+    def put(q, item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+    
+    def get(q):
+        while not stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return None
+    
+    def decode():
+        nonlocal last_frame
+        try:
+            # Each frame is held back until the next read, so the last one is copied before it is drawn on
+            pending = None
+            for idx in range(frame_count):
+                try:
+                    buffer = free_frames.get_nowait()
+                except queue.Empty:
+                    buffer = None
+                with stats.stage('decode'):
+                    ret, frame = cap.read(buffer)
+                if not ret or stop.is_set(): 
+                    break
+                if pending:
+                    put(decode_queue, pending)
+                pending = (idx, frame)
+            if pending:
+                last_frame = pending[1].copy()
+                put(decode_queue, pending)
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            put(decode_queue, None)
+    
+    def encode():
+        try:
+            written = 0
+            while True:
+                future = get(encode_queue)
+                if future is None: 
+                    break
+                frame = future.result()
+                with stats.stage('encode'):
+                    out.write(frame)
+                free_frames.put(frame)
+                written += 1
+                stats.count('frames')
+                if written % batch_size == 0:
+                    print(f"Video generation: {int(written / frame_count * 100)}%")
+                    if progress:
+                        progress(written / frame_count)
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+    
+    decoder = threading.Thread(target=decode, daemon=True)
+    encoder = threading.Thread(target=encode, daemon=True)
+    
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        decoder.start()
+        encoder.start()
+        while True:
+            item = get(decode_queue)
+            if item is None: 
+                break
+            put(encode_queue, pool.submit(timed_render, *item))
+        put(encode_queue, None)
+        decoder.join()
+        encoder.join()
+    
+    if errors:
+        raise errors[0]
+    return last_frame
+
+def render_heatmap_frame(frame, frame_events, frame_idx, w, h, darkened=False):
+    """Darken one decoded frame in place, unless the frame cache already did, and blend in the heatmap of its active clicks"""
+    if not darkened and frame.shape[:2] != (h, w):
+        frame = cv2.resize(frame, (w, h), interpolation=cv2.INTER_AREA)
+    return get_frame_compositor(w, h).blend(frame, *frame_brightness_points(frame_events, frame_idx), darkened)
+
+def write_final_heatmap_frame(out, last_frame, final_points, w, h, darkened=False):
+    """Append the aggregate heatmap of all clicks over the last decoded frame, which is already darkened if darkened"""
+    if last_frame is None:
+        last_frame = np.zeros((h, w, 3), dtype=np.uint8)
+    elif last_frame.shape[:2] != (h, w):
+        last_frame = cv2.resize(last_frame, (w, h), interpolation=cv2.INTER_AREA)
+    
+    final_heatmap = create_splat_heatmap_overlay(*final_points, w, h)
+    if final_heatmap is not None:
+        # Darken the last frame and overlay the heatmap
+        darkened_last = last_frame if darkened else darken_frame(last_frame)
+        out.write(apply_splat_heatmap(darkened_last, final_heatmap))
+
+def find_keyframes(video_path, fps, stats=None):
+    """Frame indices of the video's keyframes, from ffprobe; empty if probing fails"""
+    probe_cmd = ['ffprobe', '-v', 'quiet', '-select_streams', 'v:0', '-skip_frame', 'nokey',
+                 '-show_entries', 'frame=pts_time', '-of', 'csv=p=0', video_path]
+    try:
+        result = subprocess.run(probe_cmd, capture_output=True, text=True)
+        times = [float(line.split(',')[0]) for line in result.stdout.split() if line.strip(',')]
+        return sorted({round(t * fps) for t in times})
+    except Exception as e:
+        record_fallback('keyframe_probe', e, stats)
+        return []
+
+def plan_segments(frame_count, fps, processes, keyframes=()):
+    """Split [0, frame_count) into up to processes (start, end) ranges, snapping cuts to keyframes.
+    
+    Cutting at a keyframe lets each worker's seek start decoding right at its first frame.
+    Segments shorter than MIN_SEGMENT_SECONDS are not split off.
+    """
+    processes = max(1, min(processes, int(frame_count / max(fps * MIN_SEGMENT_SECONDS, 1))))
+    keyframes = np.asarray([k for k in keyframes if 0 < k < frame_count], dtype=np.int64)
+    
+    cuts = set()
+    for k in range(1, processes):
+        cut = frame_count * k // processes
+        if len(keyframes):
+            cut = int(keyframes[np.argmin(np.abs(keyframes - cut))])
+        cuts.add(cut)
+    
+    bounds = [0] + sorted(cuts) + [frame_count]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def slice_click_events(frame_events, start_frame, end_frame):
+    """Events for frames [start_frame, end_frame) only, so a segment worker gets just the clicks near it"""
+    frames = frame_events[0]
+    lo, hi = np.searchsorted(frames, [start_frame, end_frame])
+    return tuple(column[lo:hi] for column in frame_events)
+
+def render_segment(source_path, segment_path, fps, frame_size, scale, start_frame, end_frame, frame_events,
+                   final_points=None, workers=None):
+    """Render frames [start_frame, end_frame) of source_path to a video-only segment in a worker process.
+    
+    Returns the segment path and the segment's stats as a dict, since RenderStats
+    itself does not cross process boundaries.
+    """
+    w, h = frame_size
+    stats = RenderStats()
+    start_time = (start_frame - 0.5) / fps if start_frame > 0 else None
+    cap = FFmpegPipeReader(source_path, frame_size, scale=scale, start_time=start_time,
+                           max_frames=end_frame - start_frame)
+    out = FFmpegPipeWriter(segment_path, fps, frame_size)
+    
+    try:
+        last_frame = render_pipeline(cap, out, lambda j, frame: render_heatmap_frame(frame, frame_events, start_frame + j, w, h),
+                                     end_frame - start_frame, workers=workers, stats=stats)
+        if final_points is not None:
+            write_final_heatmap_frame(out, last_frame, final_points, w, h)
+    finally:
+        cap.release()
+    with stats.stage('encode'):
+        out.release()
+    return segment_path, stats.to_dict()
+
+def merge_segment_stats(stats, segment_stats):
+    """Add a render_segment stats dict into stats"""
+    for name, seconds in segment_stats["stage_seconds"].items():
+        stats.add_time(name, seconds)
+    for name, value in segment_stats["counts"].items():
+        stats.count(name, value)
+
+def render_segments(source_path, output_path, fps, frame_size, scale, segments, frame_events, final_points, max_duration,
+                    progress=None, stats=None):
+    """Render each time segment in its own process and join them with ffmpeg's concat demuxer.
+    
+    Segments are stitched with stream copy, so the video is encoded only once. The
+    source audio is muxed in during the same concat step. progress, if given, receives
+    the fraction of frames in finished segments.
+    """
+    segment_dir = tempfile.mkdtemp(prefix="heatmap_segments_")
+    workers = max(1, RENDER_WORKERS // len(segments))
+    frame_count = segments[-1][1]
+    rendered = [0]
+    
+    def segment_done(frames):
+        rendered[0] += frames
+        if progress:
+            progress(rendered[0] / frame_count)
     
-    if output_path:
-        print(f"Successfully generated averaged heatmap: {output_path}")
-        return output_path
-    else:
-        print("Failed to generate averaged heatmap")
-        return None
+    try:
+        with ProcessPoolExecutor(max_workers=len(segments)) as pool:
+            futures = []
+            for k, (start_frame, end_frame) in enumerate(segments):
+                segment_path = os.path.join(segment_dir, f"segment_{k:04d}.mp4")
+                is_last = k == len(segments) - 1
+                futures.append(pool.submit(render_segment, source_path, segment_path, fps, frame_size, scale,
+                                           start_frame, end_frame, slice_click_events(frame_events, start_frame, end_frame),
+                                           final_points if is_last else None, workers))
+                futures[-1].add_done_callback(lambda _, frames=end_frame - start_frame: segment_done(frames))
+            segment_paths = []
+            for future in futures:
+                segment_path, segment_stats = future.result()
+                segment_paths.append(segment_path)
+                if stats:
+                    merge_segment_stats(stats, segment_stats)
+        
+        with stats.stage('audio_merge') if stats else contextlib.nullcontext():
+            concat_segments(segment_paths, source_path, output_path, max_duration, segment_dir)
+    finally:
+        shutil.rmtree(segment_dir, ignore_errors=True)
+
+def concat_segments(segment_paths, audio_source, output_path, max_duration, list_dir):
+    """Join video-only segments with ffmpeg's concat demuxer, muxing in audio_source's audio if it has any"""
+    list_path = os.path.join(list_dir, "segments.txt")
+    with open(list_path, 'w') as f:
+        for segment_path in segment_paths:
+            f.write(f"file '{segment_path}'\n")
+    
+    concat_cmd = ['ffmpeg', '-loglevel', 'error', '-f', 'concat', '-safe', '0', '-i', list_path, '-i', audio_source,
+                  '-map', '0:v:0', '-map', '1:a:0?', '-c:v', 'copy', '-c:a', 'aac',
+                  '-t', f'{max_duration:.3f}', '-y', output_path]
+    result = subprocess.run(concat_cmd, capture_output=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg concat failed: {result.stderr.decode(errors='replace').strip()}")
 
-def generate_heatmap(video_path, tracking_data):
+def generate_heatmap(video_path, tracking_data, workers=None, decode_depth=None, encode_depth=None, processes=None,
+                     progress=None, events=None, hls_dir=None, stats=None, output_dir=None, save_data=True):
+    """Render the click heatmap over video_path into output_dir (OUTPUT_DIR by default) and return the output path, or None on failure.
+    
+    events, if given, is called as events(w, h, fps, frame_count) once the render geometry
+    is known and returns (frame_events, final_points) in place of building them from
+    tracking_data's click_data. With hls_dir, the render is also streamed there as HLS
+    segments while it runs, and the MP4 is joined from them at the end. Stage timings,
+    counts and fallbacks are recorded on stats, if given. With FRAME_CACHE_ENABLED the
+    darkened background frames are read from, or else stored in, frame_cache. save_data=False
+    skips writing tracking_data next to the output, for callers that keep their own copy.
+    """
+    stats = stats or RenderStats()
     try:
-        reduced_path, scale_x, scale_y = reduce_video_quality(video_path)
+        with stats.stage('downscale'):
+            source_path, scale_x, scale_y = reduce_video_quality(video_path, stats=stats)
+        stats.count('input_bytes', os.path.getsize(video_path))
         
         filename_base = generate_filename(tracking_data)
-        os.makedirs(OUTPUT_DIR, exist_ok=True)
-        output_path = os.path.join(OUTPUT_DIR, f"{filename_base}_heatmap.mp4")
+        output_dir = output_dir or OUTPUT_DIR
+        os.makedirs(output_dir, exist_ok=True)
+        output_path = os.path.join(output_dir, f"{filename_base}_heatmap.mp4")
         
-        save_tracking_data(tracking_data, filename_base)
+        if save_data:
+            save_tracking_data(tracking_data, filename_base)
         
-        cap = cv2.VideoCapture(reduced_path)
-        if not cap.isOpened(): 
-            return None
+        with stats.stage('probe'):
+            cap = cv2.VideoCapture(source_path)
+            if not cap.isOpened(): 
+                return None
+            
+            fps = cap.get(cv2.CAP_PROP_FPS)
+            source_w, source_h = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+            frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        w, h = round(source_w * scale_x), round(source_h * scale_y)
         
-        fps = cap.get(cv2.CAP_PROP_FPS)
-        w, h = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-        frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        use_pipe = shutil.which('ffmpeg') is not None
+        if not use_pipe:
+            record_fallback('ffmpeg_missing', "decoding with OpenCV and re-encoding for the audio merge", stats)
+        scale = (w, h) != (source_w, source_h)
+        max_duration = (frame_count + 1) / fps
         
-        # Create temporary video without audio for processing
-        temp_video_path = output_path.replace('.mp4', '_temp.mp4')
-        out = cv2.VideoWriter(temp_video_path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (w, h))
-        fade_duration = int(fps * 0.3)
+        cached_frames = video_hash = None
+        if FRAME_CACHE_ENABLED:
+            with stats.stage('probe'):
+                video_hash = hash_file(source_path)
+                cached_frames = frame_cache.get(video_hash, (w, h))
         
-        click_data = tracking_data.get('click_data', [])
-        brightness_per_frame = np.zeros((frame_count, h, w), dtype=np.float32)
+        with stats.stage('click_prep'):
+            if events:
+                frame_events, final_points = events(w, h, fps, frame_count)
+            else:
+                click_data = tracking_data.get('click_data', [])
+                frame_events = build_click_events(click_data, w, h, fps, frame_count)
+                final_points = build_final_click_points(click_data, w, h)
+            stats.count('clicks', tracking_data.get('click_count', len(tracking_data.get('click_data', []))))
+        
+        segments = [(0, frame_count)]
+        processes = processes or RENDER_PROCESSES
+        if use_pipe and processes > 1 and not hls_dir and cached_frames is None:
+            with stats.stage('probe'):
+                keyframes = find_keyframes(source_path, fps, stats)
+            segments = plan_segments(frame_count, fps, processes, keyframes)
         
-        for click in click_data:
-            x, y = int(float(click["x"]) * w), int(float(click["y"]) * h)
-            x, y = min(max(x, 0), w - 1), min(max(y, 0), h - 1)
+        frames_before = stats.counts.get('frames', 0)
+        if len(segments) > 1:
+            cap.release()
+            print(f"Rendering {len(segments)} segments in parallel")
+            render_segments(source_path, output_path, fps, (w, h), scale, segments, frame_events, final_points, max_duration,
+                            progress=progress, stats=stats)
+        else:
+            # Decode through ffmpeg so frames come out already downscaled, else resize what OpenCV decodes
+            if cached_frames is not None:
+                cap.release()
+                cap = CachedFrameReader(cached_frames)
+            elif use_pipe:
+                cap.release()
+                cap = FFmpegPipeReader(source_path, (w, h), scale=scale)
             
-            start_frame = max(0, int((click["timestamp"] * fps) - fade_duration))
-            end_frame = min(start_frame + fade_duration * 2, frame_count)
+            # Cached frames come darkened, and so do frames decoded while filling the cache
+            darkened = cached_frames is not None
+            if video_hash and not darkened:
+                writer = frame_cache.writer(cap, video_hash, (w, h), frame_count)
+                if writer:
+                    cap, darkened = writer, True
             
-            frame_range = np.arange(start_frame, end_frame)
-            fade_in = frame_range < start_frame + fade_duration
-            fade_out = frame_range >= end_frame - fade_duration
+            # Encode and mux audio in one ffmpeg pass when available, else write a temp video to merge afterwards
+            if use_pipe:
+                out = FFmpegPipeWriter(output_path, fps, (w, h), audio_source=source_path, max_duration=max_duration,
+                                      hls_dir=hls_dir)
+            else:
+                temp_video_path = output_path.replace('.mp4', '_temp.mp4')
+                out = cv2.VideoWriter(temp_video_path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (w, h))
             
-            brightness = np.ones_like(frame_range, dtype=np.float32)
-            brightness[fade_in] = (frame_range[fade_in] - start_frame) / fade_duration
-            brightness[fade_out] = (end_frame - frame_range[fade_out]) / fade_duration
+            batch_size = 50 if w * h < 1000000 else 25
+            try:
+                last_frame = render_pipeline(cap, out,
+                                             lambda j, frame: render_heatmap_frame(frame, frame_events, j, w, h, darkened),
+                                             frame_count, workers=workers, decode_depth=decode_depth,
+                                             encode_depth=encode_depth, batch_size=batch_size, progress=progress,
+                                             stats=stats)
+                
+                # The last decoded frame is the background for the final heatmap overlay
+                with stats.stage('overlay'):
+                    write_final_heatmap_frame(out, last_frame, final_points, w, h, darkened)
+            finally:
+                cap.release()
             
-            brightness_per_frame[frame_range, y, x] += brightness
-        
-        max_brightness = np.max(brightness_per_frame)
-        if max_brightness > 1.0:
-            brightness_per_frame = np.sqrt(brightness_per_frame / max_brightness)
-        
-        batch_size = 50 if w * h < 1000000 else 25
-        for i in range(0, frame_count, batch_size):
-            batch_end = min(i + batch_size, frame_count)
-            progress = int((i / frame_count) * 100)
-            print(f"Video generation: {progress}%")
+            with stats.stage('encode'):
+                out.release()
             
-            for j in range(i, batch_end):
-                ret, frame = cap.read()
-                if not ret: break
-                
-                darkened = cv2.addWeighted(frame, 0.5, np.zeros_like(frame), 0.5, 0)
-                heatmap = create_heatmap_overlay(brightness_per_frame[j], w, h)
-                
-                if heatmap is not None:
-                    result = cv2.addWeighted(darkened, 1.0, heatmap, 0.8, 0)
-                else:
-                    result = darkened
-                
-                out.write(result)
+            with stats.stage('audio_merge'):
+                if not use_pipe:
+                    merge_audio(temp_video_path, source_path, output_path, stats)
+                elif hls_dir:
+                    hls_to_mp4(hls_dir, output_path)
         
-        # Get the last frame for final heatmap overlay
-        cap.set(cv2.CAP_PROP_POS_FRAMES, frame_count - 1)
-        ret, last_frame = cap.read()
-        if not ret:
-            # If we can't get the last frame, reset to beginning and read through
-            cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
-            for _ in range(frame_count):
-                ret, last_frame = cap.read()
-                if not ret:
-                    last_frame = np.zeros((h, w, 3), dtype=np.uint8)
-                    break
+        # A decoder that gave up early leaves a short or background-less video, not a success
+        decoded = stats.counts.get('frames', 0) - frames_before
+        if frame_count and not decoded:
+            raise RuntimeError(f"no frames could be decoded from {source_path}")
+        if decoded < frame_count:
+            record_fallback('short_decode', f"decoded {decoded} of {frame_count} frames", stats)
         
-        # Add final heatmap frame with extended duration
-        final_grid = np.zeros((h, w), dtype=np.float32)
-        for click in click_data:
-            x, y = int(float(click["x"]) * w), int(float(click["y"]) * h)
-            if 0 <= x < w and 0 <= y < h:
-                final_grid[y, x] += 1
-        
-        if np.sum(final_grid) > 0:
-            if np.max(final_grid) > 1.0:
-                final_grid = np.sqrt(final_grid / np.max(final_grid))
-            final_heatmap = create_heatmap_overlay(final_grid, w, h)
-            if final_heatmap is not None:
-                # Darken the last frame and overlay the heatmap
-                darkened_last = cv2.addWeighted(last_frame, 0.5, np.zeros_like(last_frame), 0.5, 0)
-                final_frame = cv2.addWeighted(darkened_last, 1.0, final_heatmap, 0.8, 0)
-                
-                out.write(final_frame)
+        stats.count('output_bytes', os.path.getsize(output_path))
+        print("Heatmap generation completed: " + ", ".join(f"{name} {seconds:.2f}s" for name, seconds in stats.stages.items()))
+        return output_path
         
+    except Exception as e:
+        print(f"Error generating heatmap: {e}")
+        return None
+
+def read_background_frame(video_path, frame_size, frame_idx, fps):
+    """Decode only frame frame_idx of video_path at frame_size, or None if it cannot be read"""
+    w, h = frame_size
+    if shutil.which('ffmpeg'):
+        start_time = (frame_idx - 0.5) / fps if frame_idx > 0 else None
+        cap = FFmpegPipeReader(video_path, frame_size, start_time=start_time, max_frames=1)
+        try:
+            ret, frame = cap.read()
+        finally:
+            try:
+                cap.release()
+            except RuntimeError as e:
+                record_fallback('frame_seek', e)
+        if ret:
+            return frame
+    
+    cap = cv2.VideoCapture(video_path)
+    try:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, frame_idx)
+        ret, frame = cap.read()
+    finally:
         cap.release()
-        out.release()
+    if not ret:
+        return None
+    if frame.shape[:2] != (h, w):
+        frame = cv2.resize(frame, (w, h), interpolation=cv2.INTER_AREA)
+    return frame
+
+def generate_static_heatmap(video_path, tracking_data, start=None, end=None, output_folder=None):
+    """Render only the aggregate heatmap of the clicks between start and end seconds.
+    
+    Writes the heatmap over the frame at the window's end (the last frame by default)
+    as a PNG, and the blurred density it was coloured from as a float32 .npy array
+    at render resolution. Only that one background frame is decoded, so the cost does
+    not depend on the video's length. Returns (png_path, npy_path), or None on failure.
+    """
+    try:
+        output_folder = output_folder or OUTPUT_DIR
+        _, scale_x, scale_y = reduce_video_quality(video_path)
         
-        # Check if original video has audio and merge it
-        probe_cmd = ['ffprobe', '-v', 'quiet', '-select_streams', 'a', '-show_entries', 'stream=codec_type', '-of', 'csv=p=0', reduced_path]
-        has_audio = False
-        try:
-            result = subprocess.run(probe_cmd, capture_output=True, text=True)
-            has_audio = 'audio' in result.stdout
-        except:
-            pass
+        cap = cv2.VideoCapture(video_path)
+        if not cap.isOpened():
+            return None
+        fps = cap.get(cv2.CAP_PROP_FPS) or 30.0
+        source_w, source_h = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        cap.release()
+        w, h = round(source_w * scale_x), round(source_h * scale_y)
         
-        if has_audio:
-            # Get duration of temp video to ensure audio sync
-            duration_cmd = ['ffprobe', '-v', 'quiet', '-show_entries', 'format=duration', '-of', 'csv=p=0', temp_video_path]
-            try:
-                duration_result = subprocess.run(duration_cmd, capture_output=True, text=True)
-                temp_duration = float(duration_result.stdout.strip())
-                
-                # Merge video with audio
-                merge_cmd = [
-                    'ffmpeg', '-i', temp_video_path, '-i', reduced_path,
-                    '-c:v', 'libx264', '-c:a', 'aac', '-map', '0:v:0', '-map', '1:a:0',
-                    '-t', str(temp_duration), 
-                    '-y', output_path
-                ]
-                result = subprocess.run(merge_cmd, capture_output=True)
-                if result.returncode == 0:
-                    os.unlink(temp_video_path)
-                    print("Audio merged successfully")
-                else:
-                    print(f"Failed to merge audio: {result.stderr.decode() if result.stderr else 'Unknown error'}")
-                    shutil.move(temp_video_path, output_path)
-                    
-            except Exception as e:
-                print(f"Error during audio merge: {e}")
-                shutil.move(temp_video_path, output_path)
-        else:
-            print("No audio found in original video")
-            shutil.move(temp_video_path, output_path)
+        click_x, click_y, click_t = click_arrays(tracking_data.get('click_data', []))
+        in_window = np.ones(len(click_t), dtype=bool)
+        if start is not None:
+            in_window &= click_t >= start
+        if end is not None:
+            in_window &= click_t <= end
+        clicks = ClickColumns(click_x[in_window], click_y[in_window], click_t[in_window])
         
-        if reduced_path != video_path:
-            try: 
-                os.unlink(reduced_path)
-            except: 
-                pass
+        density = create_splat_density(*build_final_click_points(clicks, w, h), w, h)
+        density_grid = np.zeros((h, w), dtype=np.float32)
+        if density is not None:
+            blurred, x0, y0 = density
+            density_grid[y0:y0 + blurred.shape[0], x0:x0 + blurred.shape[1]] = blurred
         
-        print("Heatmap generation completed")
-        return output_path
+        frame_idx = max(frame_count - 1, 0)
+        if end is not None:
+            frame_idx = min(max(int(end * fps), 0), frame_idx)
+        background = read_background_frame(video_path, (w, h), frame_idx, fps)
+        if background is None:
+            print(f"Could not decode frame {frame_idx}, using a black background")
+            background = np.zeros((h, w, 3), dtype=np.uint8)
+        
+        image = darken_frame(background)
+        if density is not None:
+            image = apply_splat_heatmap(image, colorize_splat_density(density))
+        
+        filename_base = generate_filename(tracking_data)
+        os.makedirs(output_folder, exist_ok=True)
+        png_path = os.path.join(output_folder, f"{filename_base}_static.png")
+        npy_path = os.path.join(output_folder, f"{filename_base}_density.npy")
+        cv2.imwrite(png_path, image)
+        np.save(npy_path, density_grid)
         
+        print(f"Static heatmap generated: {png_path}")
+        return png_path, npy_path
+    
     except Exception as e:
-        print(f"Error generating heatmap: {e}")
+        print(f"Error generating static heatmap: {e}")
         return None
+
+def generate_heatmap_cached(video_path, tracking_data, progress=None, stats=None, video_hash=None, cache_key=None,
+                            **kwargs):
+    """generate_heatmap, but served from result_cache when the same video and clicks were rendered before.
+    
+    A hit still saves the tracking data (unless save_data=False) and places a copy of the
+    video at the usual output path, and is split into segments if an hls_dir was asked
+    for. video_hash is the video's SHA-256, if the caller already has it, and cache_key a
+    precomputed heatmap_cache_key.
+    """
+    try:
+        key = cache_key or heatmap_cache_key(video_path, tracking_data.get('click_data', []), video_hash)
+    except Exception as e:
+        print(f"Error hashing heatmap inputs: {e}")
+        return generate_heatmap(video_path, tracking_data, progress=progress, stats=stats, **kwargs)
+    
+    cached_path = result_cache.get(key)
+    if cached_path:
+        filename_base = generate_filename(tracking_data)
+        output_dir = kwargs.get('output_dir') or OUTPUT_DIR
+        os.makedirs(output_dir, exist_ok=True)
+        output_path = os.path.join(output_dir, f"{filename_base}_heatmap.mp4")
+        try:
+            shutil.copyfile(cached_path, output_path)
+        except FileNotFoundError:
+            # Evicted by another process since the lookup, so render after all
+            cached_path = None
+    metrics.inc("heatmap_cache_lookups_total", result="hit" if cached_path else "miss")
+    if cached_path:
+        if kwargs.get('save_data', True):
+            save_tracking_data(tracking_data, filename_base)
+        if kwargs.get('hls_dir'):
+            mp4_to_hls(output_path, kwargs['hls_dir'])
+        print(f"Heatmap served from cache: {output_path}")
+        return output_path
+    
+    output_path = generate_heatmap(video_path, tracking_data, progress=progress, stats=stats, **kwargs)
+    if output_path:
+        try:
+            result_cache.put(key, output_path)
+        except Exception as e:
+            print(f"Error caching heatmap: {e}")
+    return output_path
       
 def find_free_port():
     """Find a random free port"""
@@ -410,95 +2281,647 @@ def register_service(port):
     except Exception as e:
         print(f"Failed to register service: {e}")
         return None, None
+
+class HeatmapJob:
+    """One queued render: its status, progress in [0, 1] and, once finished, the output path or error"""
+    
+    def __init__(self, kind, hls_dir=None):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.hls_dir = hls_dir
+        self.stats = RenderStats()
+        self.status = 'queued'
+        self.progress = 0.0
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+        self.done = threading.Event()
+    
+    def set_progress(self, fraction):
+        self.progress = min(max(fraction, 0.0), 1.0)
     
-current_recording_process = None
-current_recording_filepath = None
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "progress": round(self.progress, 3),
+            "error": self.error,
+            "created": self.created,
+            "finished": self.finished,
+            "playlist_ready": bool(self.hls_dir) and os.path.exists(os.path.join(self.hls_dir, HLS_PLAYLIST)),
+            "metrics": self.stats.to_dict()
+        }
 
-@app.route('/start_recording', methods=['POST'])
-def start_recording():
-    global current_recording_process, current_recording_filepath
+class JobManager:
+    """Runs heatmap renders on a bounded thread pool and keeps their state for lookups.
+    
+    Submitting never blocks: jobs wait in the pool's queue until a worker is free, so at
+    most workers renders run at once. Finished jobs are forgotten after retention seconds.
+    """
+    
+    def __init__(self, workers=None, retention=None):
+        self.pool = ThreadPoolExecutor(max_workers=workers or JOB_WORKERS, thread_name_prefix='heatmap-job')
+        self.retention = retention or JOB_RETENTION_SECONDS
+        self.jobs = {}
+        self.lock = threading.Lock()
+    
+    def submit(self, kind, render, cleanup=None, hls_dir=None):
+        """Queue render(progress, stats) and return its job; cleanup() runs after it, whatever the outcome.
+        
+        hls_dir is where the render streams its segments; it is deleted with the job.
+        """
+        job = HeatmapJob(kind, hls_dir)
+        with self.lock:
+            self.prune()
+            self.jobs[job.id] = job
+        self.pool.submit(self.run, job, render, cleanup)
+        return job
+    
+    def run(self, job, render, cleanup):
+        job.status = 'running'
+        try:
+            job.result = render(job.set_progress, job.stats)
+            if job.result:
+                job.status, job.progress = 'done', 1.0
+            else:
+                job.status, job.error = 'failed', "Failed to generate heatmap"
+        except Exception as e:
+            job.status, job.error = 'failed', str(e)
+        finally:
+            if cleanup:
+                try:
+                    cleanup()
+                except Exception as e:
+                    print(f"Error cleaning up job {job.id}: {e}")
+            job.finished = time.time()
+            job.stats.add_time('job', job.finished - job.created)
+            job.stats.finish(job.status)
+            job.done.set()
+    
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+    
+    def prune(self):
+        cutoff = time.time() - self.retention
+        for job_id in [j.id for j in self.jobs.values() if j.finished and j.finished < cutoff]:
+            job = self.jobs.pop(job_id)
+            if job.hls_dir:
+                shutil.rmtree(job.hls_dir, ignore_errors=True)
+
+job_manager = JobManager()
+
+def wants_async():
+    """Whether the client asked for a job id instead of waiting for the rendered video"""
+    value = request.args.get('async') or request.form.get('async')
+    if value is None and request.is_json:
+        value = (request.get_json(silent=True) or {}).get('async')
+    return str(value).lower() in ('1', 'true', 'yes')
+
+def wants_hls():
+    """Whether the client asked for the render to be streamed as HLS segments while it runs"""
+    value = request.args.get('stream') or request.form.get('stream')
+    if value is None and request.is_json:
+        value = (request.get_json(silent=True) or {}).get('stream')
+    return str(value).lower() == 'hls'
 
-    if current_recording_process:
-        current_recording_process.terminate()
-        current_recording_process.wait()
-        current_recording_process = None    
+def job_response(job, wait):
+    """Return 202 with the job id, or, if wait, block until the job ends and send its video"""
+    if not wait:
+        body = {"status": "queued", "job_id": job.id, "status_url": f"/jobs/{job.id}",
+                "result_url": f"/jobs/{job.id}/result"}
+        if job.hls_dir:
+            body["playlist_url"] = f"/jobs/{job.id}/hls/{HLS_PLAYLIST}"
+        return jsonify(body), 202
+    
+    job.done.wait()
+    if job.status == 'done':
+        return send_file(job.result, mimetype='video/mp4', download_name='heatmap.mp4')
+    return jsonify({"status": "error", "message": job.error, "job_id": job.id, "metrics": job.stats.to_dict()}), 500
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Counters and stage histograms in Prometheus text format, or as JSON with format=json"""
+    with job_manager.lock:
+        job_counts = {status: sum(job.status == status for job in job_manager.jobs.values())
+                      for status in ('queued', 'running', 'done', 'failed')}
+    cache = result_cache.stats()
+    gauges = [(f"heatmap_jobs_{status}", count) for status, count in job_counts.items()]
+    gauges += [("heatmap_cache_entries", cache["entries"]), ("heatmap_cache_bytes", cache["size_bytes"]),
+               ("heatmap_frame_cache_bytes", frame_cache.stats()["size_bytes"])]
+    
+    if request.args.get('format') == 'json':
+        return jsonify({**metrics.snapshot(), "gauges": dict(gauges)})
+    return metrics.prometheus(gauges), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    return jsonify(result_cache.stats())
+
+@app.route('/aoi_stats', methods=['POST'])
+def aoi_stats_endpoint():
+    """AOI statistics for aois over tracking_data (one participant or a list), or over a study folder inside OUTPUT_DIR"""
+    try:
+        data = request.get_json()
+        aois = load_aoi_definitions(data.get('aois', []))
+        
+        if data.get('folder'):
+            # Clients are unauthenticated, so they only get to read study folders under the output directory
+            output_root = os.path.realpath(OUTPUT_DIR)
+            folder = os.path.realpath(os.path.join(output_root, data['folder']))
+            if os.path.commonpath([folder, output_root]) != output_root or not os.path.isdir(folder):
+                return jsonify({"status": "error", "message": "folder must be a directory inside the output directory"}), 403
+            participants = [(os.path.relpath(path, output_root), participant)
+                            for path, participant in load_participant_files(folder)]
+        else:
+            tracking_data = data.get('tracking_data', [])
+            tracking_data = tracking_data if isinstance(tracking_data, list) else [tracking_data]
+            participants = [(item.get('user_name', f"participant_{i + 1}"), item) for i, item in enumerate(tracking_data)]
+        
+        if not aois or not participants:
+            return jsonify({"status": "error", "message": "Need aois and tracking_data or folder"}), 400
+        return jsonify({"status": "success", **compute_aoi_stats(aois, participants)})
+    
+    except (ValueError, KeyError, TypeError) as e:
+        return jsonify({"status": "error", "message": f"Invalid request: {e}"}), 400
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@app.route('/generate_static_heatmap', methods=['POST'])
+def generate_static_heatmap_endpoint():
+    """Aggregate heatmap only: a PNG, or the raw density with format=npy, optionally for a start/end window"""
+    temp_input = None
     try:
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        current_recording_filepath = os.path.join(tempfile.gettempdir(), f"temp_recording_{timestamp}.mp4")
-        audio_filepath = os.path.join(tempfile.gettempdir(), f"temp_audio_{timestamp}.wav")
-        video_filepath = os.path.join(tempfile.gettempdir(), f"temp_video_{timestamp}.mp4")
+        video_file = request.files['video']
+        tracking_data = json.loads(request.form.get('tracking_data'))
+        start = request.form.get('start', type=float)
+        end = request.form.get('end', type=float)
         
-        def record():
-            global current_recording_process
+        temp_input = tempfile.NamedTemporaryFile(delete=False, suffix=".mp4")
+        video_file.save(temp_input.name)
+        
+        result = generate_static_heatmap(temp_input.name, tracking_data, start, end)
+        if not result:
+            return jsonify({"status": "error", "message": "Failed to generate static heatmap"}), 500
+        
+        png_path, npy_path = result
+        if request.args.get('format', request.form.get('format')) == 'npy':
+            return send_file(npy_path, mimetype='application/octet-stream', download_name='heatmap_density.npy')
+        return send_file(png_path, mimetype='image/png', download_name='heatmap.png')
             
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
+    finally:
+        if temp_input:
+            os.unlink(temp_input.name)
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = job_manager.get(job_id)
+    if not job:
+        return jsonify({"status": "error", "message": "Unknown job"}), 404
+    return jsonify(job.to_dict())
+
+@app.route('/jobs/<job_id>/hls/<filename>', methods=['GET'])
+def job_hls(job_id, filename):
+    """Playlist and segments of a streaming job; 404 until the first segment is written"""
+    job = job_manager.get(job_id)
+    if not job or not job.hls_dir:
+        return jsonify({"status": "error", "message": "Unknown job"}), 404
+    
+    path = os.path.join(job.hls_dir, os.path.basename(filename))
+    if not os.path.exists(path):
+        return jsonify({"status": "error", "message": "Not available yet", "job": job.to_dict()}), 404
+    
+    mimetype = 'application/vnd.apple.mpegurl' if filename.endswith('.m3u8') else 'video/mp2t'
+    response = send_file(path, mimetype=mimetype, max_age=0)
+    if filename.endswith('.m3u8'):
+        response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/jobs/<job_id>/result', methods=['GET'])
+def job_result(job_id):
+    job = job_manager.get(job_id)
+    if not job:
+        return jsonify({"status": "error", "message": "Unknown job"}), 404
+    if job.status == 'failed':
+        return jsonify({"status": "error", "message": job.error}), 500
+    if job.status != 'done':
+        return jsonify(job.to_dict()), 409
+    return send_file(job.result, mimetype='video/mp4', download_name='heatmap.mp4')
+    
+class RecordingSession:
+    """One screen capture: ffmpeg video plus SoX audio, merged into output_path when stopped.
+    
+    started is set once the capture processes are launched and finished once the merge
+    is done, so a stop waits exactly as long as the merge takes. A capture that is not
+    stopped ends by itself after RECORDING_MAX_SECONDS.
+    """
+    
+    def __init__(self):
+        self.id = uuid.uuid4().hex
+        temp_dir = tempfile.gettempdir()
+        self.output_path = os.path.join(temp_dir, f"temp_recording_{self.id}.mp4")
+        self.audio_path = os.path.join(temp_dir, f"temp_audio_{self.id}.wav")
+        self.video_path = os.path.join(temp_dir, f"temp_video_{self.id}.mp4")
+        self.created = time.time()
+        self.video_process = None
+        self.audio_process = None
+        self.started = threading.Event()
+        self.finished = threading.Event()
+        self.error = None
+        self.expiry_timer = None
+    
+    def start(self):
+        threading.Thread(target=self.record, daemon=True).start()
+    
+    def capture_output_args(self):
+        """ffmpeg output options for the screen capture"""
+        return ['-y', self.video_path]
+    
+    def record(self):
+        try:
             # Start SoX audio recording
-            audio_cmd = ['sox', '-d', audio_filepath]
-            audio_process = subprocess.Popen(audio_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            audio_cmd = ['sox', '-d', self.audio_path]
+            self.audio_process = subprocess.Popen(audio_cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
             
             # FFmpeg video recording
-            cmd = ['ffmpeg', '-f', 'avfoundation', '-i', '1', '-r', '20', 
-                  '-vf', 'crop=iw:ih*0.865:0:ih*0.085,scale=1280:720',
+            cmd = ['ffmpeg', '-f', 'avfoundation', '-i', '1', '-r', str(CAPTURE_FPS), 
+                  '-vf', f'crop=iw:ih*0.865:0:ih*0.085,scale={CAPTURE_SIZE[0]}:{CAPTURE_SIZE[1]}',
                   '-vcodec', 'libx264', '-preset', 'veryfast', '-crf', '25', 
-                  '-pix_fmt', 'yuv420p', '-y', video_filepath]
-            current_recording_process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                  '-pix_fmt', 'yuv420p'] + self.capture_output_args()
+            self.video_process = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            self.started.set()
             
-            # Wait for video recording to finish
-            current_recording_process.wait()
+            # Wait for video recording to finish, ending it if nobody stops it in time
+            try:
+                self.video_process.wait(timeout=RECORDING_MAX_SECONDS)
+            except subprocess.TimeoutExpired:
+                print(f"Recording {self.id} reached {RECORDING_MAX_SECONDS}s, stopping it")
+                self.video_process.terminate()
+                self.video_process.wait()
             
             # Stop audio recording
-            audio_process.terminate()
-            audio_process.wait()
+            self.audio_process.terminate()
+            self.audio_process.wait()
             
-            # Merge audio and video
+            self.finish_capture()
+        except Exception as e:
+            self.error = str(e)
+            for process in (self.video_process, self.audio_process):
+                if process and process.poll() is None:
+                    process.terminate()
+        finally:
+            self.started.set()
+            self.finished.set()
+    
+    def finish_capture(self):
+        """Merge the captured audio and video into output_path"""
+        try:
             merge_cmd = [
-                'ffmpeg', '-i', video_filepath, '-i', audio_filepath,
-                '-c:v', 'copy', '-c:a', 'aac', '-shortest', '-y', current_recording_filepath
+                'ffmpeg', '-i', self.video_path, '-i', self.audio_path,
+                '-c:v', 'copy', '-c:a', 'aac', '-shortest', '-y', self.output_path
             ]
-            subprocess.run(merge_cmd, capture_output=True)
-            
+            result = subprocess.run(merge_cmd, capture_output=True)
+            if result.returncode != 0:
+                stderr = result.stderr.decode(errors='replace').strip()
+                self.error = f"Merging the recording failed: {stderr}"
+                record_fallback('capture_merge', stderr)
+        finally:
             # Clean up temp files
+            for path in (self.video_path, self.audio_path):
+                with contextlib.suppress(FileNotFoundError):
+                    os.unlink(path)
+    
+    def has_recording(self):
+        return os.path.exists(self.output_path)
+    
+    def stop(self, timeout=None):
+        """End the capture and wait until it is finalised; returns whether there is a recording to render"""
+        self.started.wait()
+        if self.video_process and self.video_process.poll() is None:
+            self.video_process.terminate()
+        self.finished.wait(timeout)
+        return self.finished.is_set() and self.has_recording()
+    
+    def cancel(self):
+        """End the capture and delete what it recorded, without rendering"""
+        if self.expiry_timer:
+            self.expiry_timer.cancel()
+        self.stop()
+        self.discard()
+    
+    def discard(self):
+        if os.path.exists(self.output_path):
+            os.unlink(self.output_path)
+    
+    def render_heatmap(self, tracking_data, progress=None, hls_dir=None, stats=None):
+        """Heatmap video of the stopped recording; the recording itself is deleted afterwards"""
+        try:
+            return generate_heatmap(self.output_path, tracking_data, progress=progress, hls_dir=hls_dir, stats=stats)
+        finally:
+            if os.path.exists(self.output_path):
+                os.unlink(self.output_path)
+
+class LiveRecordingSession(RecordingSession):
+    """Recording that is captured in fixed-length segments and rendered while it runs.
+    
+    Gaze batches posted during the capture are collected by add_clicks. A renderer
+    thread turns each finished capture segment into a heatmap segment once the gaze
+    stream has reached LIVE_RENDER_MARGIN_SECONDS past the segment's fade windows, using
+    the clicks known at that point. At stop, render_heatmap re-renders only the segments
+    whose click events differ under the final click data, then joins all of them with
+    the audio by stream copy. The result matches a render of the whole recording, and
+    stop-to-result latency is about one segment's render.
+    """
+    
+    def __init__(self):
+        super().__init__()
+        self.segment_dir = tempfile.mkdtemp(prefix=f"live_recording_{self.id}_")
+        self.segment_list_path = os.path.join(self.segment_dir, "capture.csv")
+        self.clicks = []
+        self.clicks_until = 0.0
+        self.clicks_lock = threading.Lock()
+        self.clicks_changed = threading.Event()
+        self.segment_frames = {}
+        self.rendered = {}
+        self.render_lock = threading.Lock()
+    
+    def start(self):
+        super().start()
+        threading.Thread(target=self.render_live, daemon=True).start()
+    
+    def capture_output_args(self):
+        return ['-force_key_frames', f'expr:gte(t,n_forced*{LIVE_SEGMENT_SECONDS})',
+                '-f', 'segment', '-segment_time', str(LIVE_SEGMENT_SECONDS), '-reset_timestamps', '1',
+                '-segment_list', self.segment_list_path, '-segment_list_type', 'csv',
+                '-y', os.path.join(self.segment_dir, 'capture_%05d.mp4')]
+    
+    def finish_capture(self):
+        # The segments and audio are kept for render_heatmap
+        pass
+    
+    def add_clicks(self, clicks, until=None):
+        """Append a gaze batch; until is the timestamp up to which all clicks have now been sent"""
+        with self.clicks_lock:
+            self.clicks.extend(clicks)
+            latest = max((click['timestamp'] for click in clicks), default=self.clicks_until)
+            self.clicks_until = max(self.clicks_until, latest if until is None else until)
+        self.clicks_changed.set()
+    
+    def captured_segments(self):
+        """(path, first_frame, frame_count) of every capture segment ffmpeg has finished, in order"""
+        try:
+            with open(self.segment_list_path, 'r') as f:
+                names = [line.split(',')[0] for line in f if line.strip()]
+        except OSError:
+            return []
+        
+        segments = []
+        first_frame = 0
+        for name in names:
+            path = os.path.join(self.segment_dir, name)
+            if path not in self.segment_frames:
+                cap = cv2.VideoCapture(path)
+                self.segment_frames[path] = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+                cap.release()
+            segments.append((path, first_frame, self.segment_frames[path]))
+            first_frame += self.segment_frames[path]
+        return segments
+    
+    def has_recording(self):
+        return bool(self.captured_segments())
+    
+    def discard(self):
+        shutil.rmtree(self.segment_dir, ignore_errors=True)
+        if os.path.exists(self.audio_path):
+            os.unlink(self.audio_path)
+    
+    def render_pending(self, click_data, frame_count=None, final=False, progress=None, stats=None):
+        """Render every captured segment that is due and whose click events changed since it was last rendered.
+        
+        Live passes leave frame_count open and stop at the first segment the gaze stream
+        has not covered yet; the final pass uses the real frame count, renders everything
+        and appends the aggregate frame to the last segment.
+        """
+        with self.render_lock:
+            segments = self.captured_segments()
+            if not segments:
+                return [], CAPTURE_FPS
+            
+            _, scale_x, scale_y = reduce_video_quality(segments[0][0])
+            cap = cv2.VideoCapture(segments[0][0])
+            fps = cap.get(cv2.CAP_PROP_FPS) or CAPTURE_FPS
+            source_w, source_h = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+            cap.release()
+            w, h = round(source_w * scale_x), round(source_h * scale_y)
+            
+            # Windows only get cut short at the end of the recording, which a live pass has not seen yet
+            keys, sums = click_event_sums(click_data, w, h, fps, frame_count or np.iinfo(np.int32).max)
+            frame_events = normalize_click_events(keys, sums, w, h)
+            final_points = build_final_click_points(click_data, w, h) if final else None
+            use_sqrt = bool(len(sums) and np.max(sums) > 1.0)
+            
+            for k, (path, first_frame, count) in enumerate(segments):
+                segment_end = (first_frame + count) / fps
+                if not final and segment_end + FADE_SECONDS + LIVE_RENDER_MARGIN_SECONDS > self.clicks_until:
+                    break
+                
+                frames, xs, ys, brightness = slice_click_events(frame_events, first_frame, first_frame + count)
+                lo, hi = np.searchsorted(keys, [first_frame * h * w, (first_frame + count) * h * w])
+                fingerprint = hashlib.sha256()
+                fingerprint.update(keys[lo:hi].tobytes())
+                fingerprint.update(sums[lo:hi].tobytes())
+                fingerprint.update(bytes([use_sqrt]))
+                is_last = final and k == len(segments) - 1
+                if is_last:
+                    for column in final_points:
+                        fingerprint.update(np.ascontiguousarray(column).tobytes())
+                fingerprint = fingerprint.hexdigest()
+                
+                if self.rendered.get(k, (None, None))[0] != fingerprint:
+                    heatmap_path = os.path.join(self.segment_dir, f"heatmap_{k:05d}.mp4")
+                    _, segment_stats = render_segment(path, heatmap_path, fps, (w, h), (w, h) != (source_w, source_h), 0, count,
+                                                      (frames - first_frame, xs, ys, brightness),
+                                                      final_points if is_last else None)
+                    if stats:
+                        merge_segment_stats(stats, segment_stats)
+                    self.rendered[k] = (fingerprint, heatmap_path)
+                
+                if progress:
+                    progress((k + 1) / len(segments))
+            
+            return [self.rendered[k][1] for k in range(len(segments)) if k in self.rendered], fps
+    
+    def render_live(self):
+        while not self.finished.is_set():
+            self.clicks_changed.wait(timeout=1.0)
+            self.clicks_changed.clear()
+            with self.clicks_lock:
+                click_data = list(self.clicks)
             try:
-                os.unlink(video_filepath)
-                os.unlink(audio_filepath)
-            except:
-                pass
+                self.render_pending(click_data)
+            except Exception as e:
+                print(f"Live render of recording {self.id} failed: {e}")
+    
+    def render_heatmap(self, tracking_data, progress=None, hls_dir=None, stats=None):
+        """Finish the heatmap from the segments already rendered; clicks in tracking_data take precedence over streamed ones"""
+        try:
+            self.finished.wait()
+            with self.clicks_lock:
+                streamed = list(self.clicks)
+            tracking_data = {**tracking_data, 'click_data': tracking_data.get('click_data') or streamed}
+            
+            filename_base = generate_filename(tracking_data)
+            os.makedirs(OUTPUT_DIR, exist_ok=True)
+            output_path = os.path.join(OUTPUT_DIR, f"{filename_base}_heatmap.mp4")
+            save_tracking_data(tracking_data, filename_base)
+            
+            segments = self.captured_segments()
+            frame_count = segments[-1][1] + segments[-1][2]
+            heatmap_paths, fps = self.render_pending(tracking_data['click_data'], frame_count, final=True, progress=progress,
+                                                     stats=stats)
+            audio_source = self.audio_path if os.path.exists(self.audio_path) else heatmap_paths[0]
+            with stats.stage('audio_merge') if stats else contextlib.nullcontext():
+                concat_segments(heatmap_paths, audio_source, output_path, (frame_count + 1) / fps, self.segment_dir)
+            if hls_dir:
+                mp4_to_hls(output_path, hls_dir)
+            
+            print("Heatmap generation completed")
+            return output_path
+        
+        except Exception as e:
+            print(f"Error generating live heatmap: {e}")
+            return None
+        finally:
+            shutil.rmtree(self.segment_dir, ignore_errors=True)
+            if os.path.exists(self.audio_path):
+                os.unlink(self.audio_path)
+
+class RecordingManager:
+    """Registry of concurrent recording sessions by id.
+    
+    A session nobody stops or cancels is cancelled RECORDING_RETENTION_SECONDS after
+    its capture hit RECORDING_MAX_SECONDS, so abandoned recordings do not pile up.
+    """
+    
+    def __init__(self, max_seconds=None, retention=None):
+        self.expiry = (max_seconds or RECORDING_MAX_SECONDS) + (retention or RECORDING_RETENTION_SECONDS)
+        self.sessions = {}
+        self.lock = threading.Lock()
+    
+    def start(self, live=False):
+        session = LiveRecordingSession() if live else RecordingSession()
+        with self.lock:
+            self.sessions[session.id] = session
+        session.start()
+        
+        session.expiry_timer = threading.Timer(self.expiry, self.expire, args=(session.id,))
+        session.expiry_timer.daemon = True
+        session.expiry_timer.start()
+        return session
+    
+    def get(self, session_id):
+        with self.lock:
+            return self.sessions.get(session_id)
+    
+    def pop(self, session_id=None):
+        """Remove and return the session with session_id, or the only session if no id is given"""
+        with self.lock:
+            if session_id:
+                session = self.sessions.pop(session_id, None)
+            elif len(self.sessions) == 1:
+                session = self.sessions.popitem()[1]
+            else:
+                return None
+        if session and session.expiry_timer:
+            session.expiry_timer.cancel()
+        return session
+    
+    def expire(self, session_id):
+        session = self.pop(session_id)
+        if session:
+            print(f"Recording {session_id} was never stopped, discarding it")
+            session.cancel()
+
+recording_manager = RecordingManager()
+
+@app.route('/start_recording', methods=['POST'])
+def start_recording():
+    try:
+        data = request.get_json(silent=True) or {}
+        session = recording_manager.start(live=bool(data.get('live')))
+        return jsonify({"status": "success", "message": "Recording with SoX audio started", "session_id": session.id,
+                        "live": isinstance(session, LiveRecordingSession)})
         
-        threading.Thread(target=record).start()
-        return jsonify({"status": "success", "message": "Recording with SoX audio started"})
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@app.route('/recording/<session_id>/gaze', methods=['POST'])
+def add_recording_gaze(session_id):
+    """Gaze batch for a live recording: click_data, plus until, the timestamp the batch is complete up to"""
+    try:
+        session = recording_manager.get(session_id)
+        if not session:
+            return jsonify({"status": "error", "message": "Unknown recording"}), 404
+        if not isinstance(session, LiveRecordingSession):
+            return jsonify({"status": "error", "message": "Recording was not started with live=true"}), 400
         
+        data = request.get_json()
+        session.add_clicks(data.get('click_data', []), data.get('until'))
+        return jsonify({"status": "success", "received": len(data.get('click_data', [])),
+                        "rendered_segments": len(session.rendered)})
+    
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
     
 @app.route('/stop_recording', methods=['POST'])
 def stop_recording():
-    global current_recording_process, current_recording_filepath
-    
     try:
         data = request.get_json()
         tracking_data = data.get('tracking_data', {})
-                
-        if current_recording_process:
-            current_recording_process.terminate()
-            current_recording_process.wait()
-            current_recording_process = None
-            time.sleep(2)
-            
-            if current_recording_filepath and os.path.exists(current_recording_filepath):
-                heatmap_path = generate_heatmap(current_recording_filepath, tracking_data)
-                os.unlink(current_recording_filepath)
-                
-                if heatmap_path:
-                    return send_file(heatmap_path, mimetype='video/mp4', download_name='heatmap.mp4')
-                else:
-                    return jsonify({"status": "error", "message": "Failed to generate heatmap"}), 500
-            else:
-                return jsonify({"status": "error", "message": "Recording file not found"}), 500
-        else:
-            return jsonify({"status": "error", "message": "No active recording"}), 400
+        
+        # Clients that predate session ids can stop a recording only while it is the only one
+        session = recording_manager.pop(data.get('session_id'))
+        if not session:
+            message = "No active recording" if data.get('session_id') or not recording_manager.sessions else \
+                "session_id is required while several recordings are active"
+            return jsonify({"status": "error", "message": message}), 400
+        
+        if not session.stop():
+            return jsonify({"status": "error", "message": session.error or "Recording file not found"}), 500
+        
+        hls_dir = tempfile.mkdtemp(prefix="heatmap_hls_") if wants_hls() else None
+        job = job_manager.submit('spatial',
+                                 lambda progress, stats: session.render_heatmap(tracking_data, progress=progress,
+                                                                                hls_dir=hls_dir, stats=stats),
+                                 hls_dir=hls_dir)
+        return job_response(job, wait=not (wants_async() or hls_dir))
             
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
+@app.route('/recording/<session_id>', methods=['DELETE'])
+def cancel_recording(session_id):
+    """End a recording and delete it without rendering a heatmap"""
+    session = recording_manager.pop(session_id)
+    if not session:
+        return jsonify({"status": "error", "message": "Unknown recording"}), 404
+    session.cancel()
+    return jsonify({"status": "success", "message": "Recording cancelled"})
+
+def submit_video_heatmap(video_path, tracking_data, cleanup, video_hash=None):
+    """Queue the heatmap render of an uploaded video and answer as job_response does"""
+    hls_dir = tempfile.mkdtemp(prefix="heatmap_hls_") if wants_hls() else None
+    job = job_manager.submit('video',
+                             lambda progress, stats: generate_heatmap_cached(video_path, tracking_data, progress=progress,
+                                                                             stats=stats, video_hash=video_hash,
+                                                                             hls_dir=hls_dir),
+                             cleanup=cleanup, hls_dir=hls_dir)
+    return job_response(job, wait=not (wants_async() or hls_dir))
+
 @app.route('/generate_heatmap', methods=['POST'])
 def generate_heatmap_endpoint():
     try:
@@ -508,14 +2931,208 @@ def generate_heatmap_endpoint():
         temp_input = tempfile.NamedTemporaryFile(delete=False, suffix=".mp4")
         video_file.save(temp_input.name)
         
-        heatmap_path = generate_heatmap(temp_input.name, tracking_data)
-        os.unlink(temp_input.name)
+        return submit_video_heatmap(temp_input.name, tracking_data, cleanup=lambda: os.unlink(temp_input.name))
+            
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+class Upload:
+    """A video arriving in chunks, written straight to a .part file in UPLOAD_DIR.
+    
+    Chunks must continue exactly at offset, the number of bytes already on disk, so a
+    client whose connection dropped asks for the offset and resends from there. The
+    SHA-256 is updated as bytes land, so finalizing neither rereads the file nor hashes
+    it again for the result cache.
+    """
+    
+    def __init__(self, size=None, filename=None, upload_dir=None):
+        self.id = uuid.uuid4().hex
+        self.size = size
+        self.filename = filename
+        self.path = os.path.join(upload_dir or UPLOAD_DIR, f"{self.id}.part")
+        self.offset = 0
+        self.digest = hashlib.sha256()
+        self.complete = False
+        self.updated = time.time()
+        self.lock = threading.Lock()
+        
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        open(self.path, 'wb').close()
+    
+    def write(self, offset, stream):
+        """Append stream's bytes at offset and return the new offset.
         
-        if heatmap_path:
-            return send_file(heatmap_path, mimetype='video/mp4', download_name='heatmap.mp4')
-        else:
-            return jsonify({"status": "error", "message": "Failed to generate heatmap"}), 500
+        Raises ValueError if offset is not where the upload stands, and RuntimeError if
+        another chunk is still being written. Bytes read before the connection drops are
+        kept, so the next chunk resumes after them.
+        """
+        if not self.lock.acquire(blocking=False):
+            raise RuntimeError("Another chunk of this upload is still being written")
+        try:
+            if self.complete:
+                raise ValueError("Upload is already finalized")
+            if offset != self.offset:
+                raise ValueError(f"Chunk starts at {offset}, upload is at {self.offset}")
             
+            with open(self.path, 'r+b') as f:
+                f.seek(offset)
+                try:
+                    for data in iter(lambda: stream.read(UPLOAD_READ_SIZE), b''):
+                        if self.size is not None and self.offset + len(data) > self.size:
+                            raise ValueError(f"Chunk goes past the declared size of {self.size} bytes")
+                        f.write(data)
+                        self.digest.update(data)
+                        self.offset += len(data)
+                finally:
+                    f.flush()
+                    self.updated = time.time()
+            return self.offset
+        finally:
+            self.lock.release()
+    
+    def finalize(self, sha256):
+        """Check the received bytes against the client's SHA-256 and return the hex digest"""
+        with self.lock:
+            if self.complete:
+                raise ValueError("Upload is already finalized")
+            if self.size is not None and self.offset != self.size:
+                raise ValueError(f"Upload has {self.offset} of {self.size} bytes")
+            digest = self.digest.hexdigest()
+            if sha256 and sha256.lower() != digest:
+                raise ValueError(f"Checksum mismatch: received bytes hash to {digest}, cancel and upload again")
+            self.complete = True
+            return digest
+    
+    def remove(self):
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(self.path)
+    
+    def to_dict(self):
+        return {"upload_id": self.id, "offset": self.offset, "size": self.size, "complete": self.complete,
+                "upload_url": f"/uploads/{self.id}"}
+
+class UploadManager:
+    """Registry of resumable uploads by id; uploads idle for longer than retention are deleted.
+    
+    The registry lives in memory, so prune also deletes .part files in upload_dir that
+    no upload owns, such as those left by a server restart, once they are as old.
+    """
+    
+    def __init__(self, retention=None, upload_dir=None):
+        self.retention = retention or UPLOAD_RETENTION_SECONDS
+        self.upload_dir = upload_dir or UPLOAD_DIR
+        self.uploads = {}
+        self.lock = threading.Lock()
+    
+    def create(self, size=None, filename=None):
+        upload = Upload(size, filename, self.upload_dir)
+        with self.lock:
+            self.prune()
+            self.uploads[upload.id] = upload
+        return upload
+    
+    def get(self, upload_id):
+        with self.lock:
+            return self.uploads.get(upload_id)
+    
+    def pop(self, upload_id):
+        with self.lock:
+            return self.uploads.pop(upload_id, None)
+    
+    def prune(self):
+        cutoff = time.time() - self.retention
+        for upload_id in [u.id for u in self.uploads.values() if not u.complete and u.updated < cutoff]:
+            self.uploads.pop(upload_id).remove()
+        
+        owned = {upload.path for upload in self.uploads.values()}
+        for path in glob.glob(os.path.join(self.upload_dir, "*.part")):
+            with contextlib.suppress(OSError):
+                if path not in owned and os.path.getmtime(path) < cutoff:
+                    os.unlink(path)
+
+upload_manager = UploadManager()
+
+@app.route('/uploads', methods=['POST'])
+def create_upload():
+    """Start a resumable upload: size is the total byte count, filename is informational"""
+    try:
+        data = request.get_json(silent=True) or {}
+        size = data.get('size')
+        if size is not None and (not isinstance(size, int) or size < 0):
+            return jsonify({"status": "error", "message": "size must be a non-negative byte count"}), 400
+        
+        upload = upload_manager.create(size, data.get('filename'))
+        return jsonify({"status": "success", **upload.to_dict()}), 201
+    
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@app.route('/uploads/<upload_id>', methods=['GET'])
+def upload_status(upload_id):
+    """Where a dropped upload resumes: the next chunk must start at offset"""
+    upload = upload_manager.get(upload_id)
+    if not upload:
+        return jsonify({"status": "error", "message": "Unknown upload"}), 404
+    return jsonify(upload.to_dict())
+
+@app.route('/uploads/<upload_id>', methods=['PUT', 'PATCH'])
+def upload_chunk(upload_id):
+    """Raw chunk bytes in the body, starting at the offset query parameter or Upload-Offset header"""
+    upload = upload_manager.get(upload_id)
+    if not upload:
+        return jsonify({"status": "error", "message": "Unknown upload"}), 404
+    
+    offset = request.args.get('offset', request.headers.get('Upload-Offset'))
+    if offset is None:
+        return jsonify({"status": "error", "message": "Missing chunk offset", **upload.to_dict()}), 400
+    try:
+        offset = int(offset)
+    except ValueError:
+        return jsonify({"status": "error", "message": f"Chunk offset {offset!r} is not an integer", **upload.to_dict()}), 400
+    
+    try:
+        upload.write(offset, request.stream)
+        return jsonify({"status": "success", **upload.to_dict()})
+    except (ValueError, RuntimeError) as e:
+        return jsonify({"status": "error", "message": str(e), **upload.to_dict()}), 409
+    except Exception as e:
+        # A dropped connection keeps the bytes read so far; the client resumes from offset
+        return jsonify({"status": "error", "message": str(e), **upload.to_dict()}), 500
+
+@app.route('/uploads/<upload_id>', methods=['DELETE'])
+def cancel_upload(upload_id):
+    upload = upload_manager.pop(upload_id)
+    if not upload:
+        return jsonify({"status": "error", "message": "Unknown upload"}), 404
+    upload.remove()
+    return jsonify({"status": "success", "message": "Upload cancelled"})
+
+@app.route('/uploads/<upload_id>/finalize', methods=['POST'])
+def finalize_upload(upload_id):
+    """Verify the upload against sha256 and render its heatmap with tracking_data, as /generate_heatmap does"""
+    upload = upload_manager.get(upload_id)
+    if not upload:
+        return jsonify({"status": "error", "message": "Unknown upload"}), 404
+    
+    try:
+        data = request.get_json()
+        tracking_data = data.get('tracking_data')
+        if isinstance(tracking_data, str):
+            tracking_data = json.loads(tracking_data)
+        if tracking_data is None:
+            return jsonify({"status": "error", "message": "Missing tracking_data"}), 400
+        
+        try:
+            video_hash = upload.finalize(data.get('sha256'))
+        except ValueError as e:
+            return jsonify({"status": "error", "message": str(e), **upload.to_dict()}), 409
+        
+        def cleanup():
+            upload_manager.pop(upload.id)
+            upload.remove()
+        
+        return submit_video_heatmap(upload.path, tracking_data, cleanup=cleanup, video_hash=video_hash)
+    
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
@@ -524,12 +3141,44 @@ def main():
     parser.add_argument('--folder', '-f', type=str, help='Folder path containing JSON files and video to process')
     parser.add_argument('--server', '-s', action='store_true', help='Start the Flask server (default behavior)')
     parser.add_argument('--port', '-p', type=int, help='Port to run server on (default: random free port)')
+    parser.add_argument('--processes', type=int, help='Render each video as this many parallel time segments (default: 1)')
+    parser.add_argument('--batch', '-b', type=str, help='Root directory or manifest of study folders to process in parallel')
+    parser.add_argument('--workers', '-w', type=int, help='Folders processed at once in batch mode (default: CPU count)')
+    parser.add_argument('--summary', type=str, help='Where batch mode writes its JSON summary (default: in the output directory)')
+    parser.add_argument('--force', action='store_true', help='In batch mode, also process folders whose outputs are up to date')
+    parser.add_argument('--static', action='store_true', help='With --folder, only write the aggregate heatmap PNG and density array')
+    parser.add_argument('--start', type=float, help='With --static, ignore clicks before this many seconds')
+    parser.add_argument('--end', type=float, help='With --static, ignore clicks after this many seconds')
+    parser.add_argument('--convert', type=str, help='Write columnar .npz sidecars for the tracking JSON files under a directory')
+    parser.add_argument('--aoi', nargs='?', const='', metavar='FILE',
+                        help="With --folder, write AOI statistics instead of a heatmap (AOIs from FILE, default: the folder's aois.json)")
+    parser.add_argument('--frame-cache', action='store_true',
+                        help='Keep decoded background frames on disk so re-renders of the same video skip decoding')
     
     args = parser.parse_args()
     
-    if args.folder:
+    global RENDER_PROCESSES, FRAME_CACHE_ENABLED
+    if args.processes:
+        RENDER_PROCESSES = args.processes
+    if args.frame_cache:
+        FRAME_CACHE_ENABLED = True
+    
+    if args.convert:
+        # Sidecar conversion mode
+        convert_tracking_files(args.convert)
+        sys.exit(0)
+    elif args.batch:
+        # Batch mode
+        summary = process_batch(args.batch, workers=args.workers, summary_path=args.summary, force=args.force)
+        sys.exit(1 if summary["counts"]["failed"] else 0)
+    elif args.folder:
         # Process folder mode
-        result = process_folder(args.folder)
+        if args.aoi is not None:
+            result = process_folder_aoi(args.folder, args.aoi or None)
+        elif args.static:
+            result = process_folder_static(args.folder, args.start, args.end)
+        else:
+            result = process_folder(args.folder)
         if result:
             sys.exit(0)
         else:
@@ -542,9 +3191,13 @@ def main():
         
         zeroconf, service_info = register_service(port)
         
+        # Uploads from before a restart cannot be resumed, so clear out the stale ones now
+        with upload_manager.lock:
+            upload_manager.prune()
+        
         try:
             print(f"Server starting on {local_ip}:{port}")
-            app.run(host='0.0.0.0', port=port, debug=True)
+            app.run(host='0.0.0.0', port=port, threaded=True)
         finally:
             if zeroconf and service_info:
                 zeroconf.unregister_service(service_info)
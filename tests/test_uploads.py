@@ -0,0 +1,84 @@
+import hashlib
+import io
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import heatmap
+
+
+class DroppingStream(io.BytesIO):
+    """Request body that fails after drop_at bytes, like a connection dropping mid-chunk"""
+
+    def __init__(self, data, drop_at):
+        super().__init__(data)
+        self.drop_at = drop_at
+
+    def read(self, size=-1):
+        remaining = self.drop_at - self.tell()
+        if remaining <= 0:
+            raise ConnectionResetError("connection dropped")
+        return super().read(remaining if size is None or size < 0 else min(size, remaining))
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+
+class UploadChunkTest(unittest.TestCase):
+    def setUp(self):
+        self.upload_dir = tempfile.TemporaryDirectory()
+        self.previous_manager = heatmap.upload_manager
+        heatmap.upload_manager = heatmap.UploadManager(upload_dir=self.upload_dir.name)
+        self.client = heatmap.app.test_client()
+        self.data = os.urandom(3000)
+        response = self.client.post('/uploads', json={"size": len(self.data)})
+        self.assertEqual(response.status_code, 201)
+        self.url = response.get_json()['upload_url']
+
+    def tearDown(self):
+        heatmap.upload_manager = self.previous_manager
+        self.upload_dir.cleanup()
+
+    def test_offset_in_header(self):
+        response = self.client.put(self.url, data=self.data[:1000], headers={"Upload-Offset": "0"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['offset'], 1000)
+
+        response = self.client.put(self.url, data=self.data[1000:], headers={"Upload-Offset": "1000"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['offset'], len(self.data))
+
+    def test_invalid_offset(self):
+        response = self.client.put(self.url, data=self.data, headers={"Upload-Offset": "start"})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.put(f"{self.url}?offset=1.5", data=self.data)
+        self.assertEqual(response.status_code, 400)
+
+    def test_wrong_offset_conflicts(self):
+        response = self.client.put(self.url, data=self.data, headers={"Upload-Offset": "10"})
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.get_json()['offset'], 0)
+
+    def test_resume_after_dropped_chunk(self):
+        response = self.client.put(self.url, input_stream=DroppingStream(self.data, 1200),
+                                   headers={"Upload-Offset": "0"})
+        self.assertEqual(response.status_code, 500)
+
+        offset = self.client.get(self.url).get_json()['offset']
+        self.assertEqual(offset, 1200)
+
+        response = self.client.patch(self.url, data=self.data[offset:], headers={"Upload-Offset": str(offset)})
+        self.assertEqual(response.status_code, 200)
+
+        upload = heatmap.upload_manager.get(self.url.rsplit('/', 1)[1])
+        self.assertEqual(upload.finalize(hashlib.sha256(self.data).hexdigest()), hashlib.sha256(self.data).hexdigest())
+        with open(upload.path, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+
+
+if __name__ == '__main__':
+    unittest.main()